@@ -3,10 +3,9 @@ import sys
 import pathlib
 import argparse
 import logging
-import shutil
-import xarray as xr
 import yaml
 from itertools import chain
+from votoutils.utilities.nc_metadata import patch_nc_attrs, patch_ncs
 
 script_dir = pathlib.Path(__file__).parent.absolute()
 sys.path.append(str(script_dir))
@@ -14,28 +13,16 @@ os.chdir(script_dir)
 _log = logging.getLogger(__name__)
 
 
-def nc_update(nc_path, yaml_path, tempfile):
-    _log.info(f"working on {nc_path}")
-    ds = xr.open_dataset(nc_path)
+def read_yaml_metadata(yaml_path):
     with open(yaml_path) as fin:
         deployment = yaml.safe_load(fin)
     _log.info('read files successfully')
-    meta = ds.attrs
-    new_meta = deployment['metadata']
-    for key, value in new_meta.items():
-        if key not in meta.keys():
-            meta[key] = value
-            _log.info(f"added {key}: {value}")
-            continue
-        if meta[key] == value:
-            continue
-        _log.info(f"updated {key}. old: {meta[key]}, new: {value}")
-        meta[key] = value
+    return deployment['metadata']
 
-    ds.attrs = meta
-    ds.to_netcdf(tempfile)
-    shutil.move(tempfile, nc_path)
-    _log.info("Successfully saved nc")
+
+def nc_update(nc_path, yaml_path, tempfile=None):
+    """Update the global attributes of nc_path from the metadata of the deployment yaml, in place where possible"""
+    patch_nc_attrs(nc_path, read_yaml_metadata(yaml_path), tempfile=tempfile)
 
 
 if __name__ == '__main__':
@@ -68,8 +55,6 @@ if __name__ == '__main__':
         if not nc_files:
             _log.error(f"no ncs found in path {root_dir}")
         _log.info(f"Found {len(nc_files_flat)}")
-        for nc in nc_files_flat:
-            temp_nc = pathlib.Path("/tmp") / pathlib.Path(nc).name
-            nc_update(nc, yml_file, temp_nc)
+        patch_ncs(nc_files_flat, read_yaml_metadata(yml_file))
         _log.info(f"Updated all ncs in {root_dir}")
     _log.info("Success! Updated all ncs")
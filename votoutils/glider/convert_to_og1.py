@@ -170,7 +170,7 @@ vars_as_is = ['altimeter', 'nav_resource', 'angular_cmd', 'angular_pos', 'ballas
               'declination', 'desired_heading', 'dive_num', 'internal_pressure', 'internal_temperature', 'linear_cmd',
               'linear_pos', 'security_level', 'voltage', 'distance_over_ground', 'ad2cp_beam1_cell_number1',
               'ad2cp_beam2_cell_number1', 'ad2cp_beam3_cell_number1', 'ad2cp_beam4_cell_number1',
-              'vertical_distance_to_seafloor', 'profile_direction', 'profile_num', 'nav_state', ]
+              'vertical_distance_to_seafloor', 'profile_direction', 'profile_num', 'nav_state', 'basin', ]
 
 
 # + ['backscatter_raw', 'oxygen_phase', 'phycocyanin', 'phycocyanin_raw', 'down_irradiance_532', 'turbidity_raw', 'internal_temperature_PAR', 'methane_concentration', 'methane_raw_concentration', 'mets_raw_temperature', 'mets_temperature', 'nitrate_concentration', 'nitrate_molar_concentration', 'suna_internal_humidity', 'suna_internal_temperature'] # DELETE
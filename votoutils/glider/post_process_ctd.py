@@ -2,53 +2,217 @@ import gsw
 import numpy as np
 from scipy.interpolate import interp1d
 import logging
-import pandas as pd
+from votoutils.glider.thermodynamics import ThermoContext, threaded_elementwise
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 _log = logging.getLogger(__name__)
 
 
-def interp(x, y, xi):
+def interp(x, y, xi, low_memory=False):
     _gg = np.isfinite(x + y)
+    if low_memory and not np.any(np.diff(x[_gg]) <= 0):
+        # np.interp works without the intermediate arrays of interp1d. Agrees with interp1d to float64 rounding
+        return np.interp(xi, x[_gg], y[_gg], left=np.nan, right=np.nan)
     return interp1d(x[_gg], y[_gg], bounds_error=False, fill_value=np.nan)(xi)
 
 
-def salinity_pressure_correction(ds):
+def salinity_pressure_correction(ds, thermo=None, low_memory=False):
     """correct salinity from pressure lag"""
+    thermo = thermo or ThermoContext(ds)
     _log.info("performing RBR salinity pressure correction")
     X2 = 1.8e-06
     X3 = -9.472e-10
     X4 = 2.112e-13
     Cmeas = ds['conductivity'].values
     Pmeas = ds['pressure'].values
-    ds['conductivity'].values = Cmeas / (1 + X2 * Pmeas + X3 * Pmeas ** 2 + X4 * Pmeas ** 3)
+    if low_memory and Cmeas.dtype.kind == "f" and Cmeas.flags.writeable:
+        # Horner form of the same polynomial, divided in place. Agrees with the default to float64 rounding
+        denominator = X4 * Pmeas
+        denominator += X3
+        denominator *= Pmeas
+        denominator += X2
+        denominator *= Pmeas
+        denominator += 1
+        Cmeas /= denominator
+        del denominator
+    else:
+        ds['conductivity'].values = Cmeas / (1 + X2 * Pmeas + X3 * Pmeas ** 2 + X4 * Pmeas ** 3)
     ds['conductivity'].attrs['comment'] = "Corrected for pressure lag in post-processing. "
-    ds['salinity'].values = gsw.SP_from_C(ds['conductivity'].values, ds['temperature'].values, Pmeas)
+    ds['salinity'].values = thermo.practical_salinity()
     ds['salinity'].attrs['comment'] = "Corrected for pressure lag in post-processing. "
     return ds
 
 
-def pandas_fill(arr):
-    return pd.DataFrame(arr).bfill().values[:, 0]
+def backfill(arr):
+    """Fill NaNs with the next valid value, as pandas bfill. Trailing NaNs are kept"""
+    arr = np.asarray(arr)
+    valid = ~np.isnan(arr)
+    next_valid = np.where(valid, np.arange(len(arr)), len(arr))
+    next_valid = np.minimum.accumulate(next_valid[::-1])[::-1]
+    filled = arr[np.minimum(next_valid, len(arr) - 1)]
+    filled[next_valid == len(arr)] = np.nan
+    return filled
 
 
-def correct_rbr_lag(ds):
+def _lag_bias_loop(a, b, x, bias):
+    for sample in range(1, len(bias)):
+        bias[sample] = -b[sample] * bias[sample - 1] + a[sample] * (x[sample] - x[sample - 1])
+    return bias
+
+
+if njit:
+    _lag_bias_loop = njit(cache=True)(_lag_bias_loop)
+
+
+def lag_bias(a, b, x):
+    """
+    First order recursive filter of Lueck and Picklo (1990) with time-varying coefficients
+    bias[n] = -b[n] * bias[n - 1] + a[n] * (x[n] - x[n - 1]), bias[0] = 0
+    Compiled with numba if it is installed. Otherwise the recursion runs on python floats, which gives the same
+    float64 results as indexing numpy arrays sample by sample at a fraction of the cost
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    if njit:
+        return _lag_bias_loop(a, b, x, np.zeros(len(x)))
+    bias = [0.0] * len(x)
+    prev_bias = 0.0
+    a_list, b_list, x_list = a.tolist(), b.tolist(), x.tolist()
+    for sample in range(1, len(bias)):
+        prev_bias = -b_list[sample] * prev_bias + a_list[sample] * (x_list[sample] - x_list[sample - 1])
+        bias[sample] = prev_bias
+    return np.array(bias, dtype=np.float64)
+
+
+def segment_bounds(segment_ids, num_groups):
+    """
+    Split samples into about num_groups contiguous groups of similar size, cut only where segment_ids changes
+    :return: list of group boundaries, starting at 0 and ending at the number of samples
+    """
+    ids = np.asarray(segment_ids, dtype=np.float64)
+    same = (ids[1:] == ids[:-1]) | (np.isnan(ids[1:]) & np.isnan(ids[:-1]))
+    changes = np.flatnonzero(~same) + 1
+    if not len(changes) or num_groups < 2:
+        return [0, len(ids)]
+    targets = np.arange(1, num_groups) * len(ids) / num_groups
+    cuts = np.unique(changes[np.minimum(np.searchsorted(changes, targets), len(changes) - 1)])
+    return [0, *cuts.tolist(), len(ids)]
+
+
+def _segment_lag_bias(coefficients, x):
+    """
+    Lag bias of each (a, b) pair over a segment starting from zero bias, and the factor by which the bias before the
+    segment propagates to each sample of it. The first sample of x is the last sample of the previous segment
+    """
+    results = []
+    for a, b in coefficients:
+        propagator = np.ones(len(x))
+        propagator[1:] = np.cumprod(-b[1:])
+        results.append((lag_bias(a, b, x), propagator))
+    return results
+
+
+def segmented_lag_bias(coefficients, x, bounds, workers=None):
+    """
+    lag_bias for several (a, b) pairs, with the samples split into groups at bounds that are filtered concurrently.
+    Each group is filtered from zero bias, then the groups are stitched in time order by adding the bias carried
+    over from the previous group times its propagator. The recursion is linear, so this is the serial result up to
+    float64 rounding (relative differences ~1e-13), not an approximation that resets the filter at each dive.
+    :return: list of bias arrays, one per (a, b) pair
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            first = max(start - 1, 0)
+            futures.append(pool.submit(_segment_lag_bias, [(a[first:end], b[first:end]) for a, b in coefficients],
+                                       x[first:end]))
+        group_results = [future.result() for future in futures]
+    biases = [np.empty(len(x)) for pair in coefficients]
+    for start, end, results in zip(bounds[:-1], bounds[1:], group_results):
+        first = max(start - 1, 0)
+        for bias, (group_bias, propagator) in zip(biases, results):
+            # bias[first] is the last sample of the previous group, zero for the first group
+            carried = bias[first] if start else 0
+            bias[first:end] = group_bias + propagator * carried
+    return biases
+
+
+def lag_coefficients(spd, fn, alpha_scale, alpha_exponent, tau_scale, tau_exponent=None):
+    """
+    Coefficients a and b of Lueck and Picklo (1990) for alpha = alpha_scale * spd ** alpha_exponent and
+    tau = tau_scale * spd ** tau_exponent, or a constant tau if tau_exponent is None. Temporaries are updated in
+    place, in the same order of operations as the textbook expressions, so the results are identical to them
+    """
+    alpha = spd ** alpha_exponent
+    alpha *= alpha_scale
+    a = alpha * (4 * fn)
+    if tau_exponent is None:
+        a *= tau_scale
+        a /= 1 + 4 * fn * tau_scale
+    else:
+        tau = spd ** tau_exponent
+        tau *= tau_scale
+        a *= tau
+        tau *= 4 * fn
+        tau += 1
+        a /= tau
+        del tau
+    b = a * 2
+    b /= alpha
+    np.subtract(1, b, out=b)
+    return a, b
+
+
+def set_potential_density(ds, thermo):
+    if "potential_density" in list(ds):
+        ds['potential_density'].values = 1000 + thermo.sigma0()
+    else:
+        ds['potential_density'] = ("time", 1000 + thermo.sigma0())
+    return ds
+
+
+def set_density(ds, thermo):
+    if "density" in list(ds):
+        ds['density'].values = thermo.density()
+    else:
+        ds['density'] = ("time", thermo.density())
+    return ds
+
+
+def correct_rbr_lag(ds, workers=None, segment_by="dive_num", thermo=None, low_memory=False, derived=True):
     """
     Thermal lag from Thermal Inertia of Conductivity Cells: Observations with a Sea-Bird Cell
     Rolf G. Lueck and James J. Picklo https://doi.org/10.1175/1520-0426(1990)007<0756:TIOCCO>2.0.CO;2
+    :param workers: optional number of processes. If more than 1, the recursive filters run concurrently on groups of
+     whole dives and are stitched back in time order. Salinity differs from the serial result only by float64
+     rounding, well below 1e-10 PSU
+    :param segment_by: variable whose changes mark where the mission may be split, e.g. dive_num or profile_index
+    :param thermo: optional ThermoContext of ds, shared with the other processing steps
+    :param low_memory: interpolate with np.interp instead of interp1d, which agrees to float64 rounding
+    :param derived: also recompute potential_density and density from the corrected data
     :return:
     """
+    thermo = thermo or ThermoContext(ds)
     raw_seconds = (ds['time'].values - np.nanmin(ds['time'].values))
     if "float" not in str(ds.time.dtype):
         raw_seconds = raw_seconds / np.timedelta64(1, 's')
-    vert_spd = np.gradient(-gsw.z_from_p(ds['pressure'].values, ds['latitude'].values), raw_seconds)
+    vert_spd = np.gradient(-threaded_elementwise(gsw.z_from_p, ds['pressure'].values, ds['latitude'].values),
+                           raw_seconds)
 
-    spd = np.abs(vert_spd / np.sin(np.deg2rad(ds['pitch'].values)))
+    spd = vert_spd
+    spd /= np.sin(np.deg2rad(ds['pitch'].values))
+    np.abs(spd, out=spd)
 
     spd[spd < 0.01] = 0.01
     spd[spd > 1] = 1
     spd[~np.isfinite(spd)] = 0.01
 
-    spd = spd * 100
+    spd *= 100
 
     raw_temp = ds['temperature'].values
 
@@ -59,50 +223,51 @@ def correct_rbr_lag(ds):
     _log.info('Performing thermal mass correction... Assuming a sampling frequency of ' + str(Fs) + ' Hz.')
     fn = Fs / 2
 
-    corr_temp = raw_temp.copy()
-
-    # Correct temperature probe's thermal lag to get real temperature
-    alpha = 0.05 * spd ** (-0.83)
-    tau = 375
-    bias_temp = np.full_like(corr_temp, 0)
-    a = 4 * fn * alpha * tau / (1 + 4 * fn * tau)  # Lueck and Picklo (1990)
-    b = 1 - 2 * a / alpha  # Lueck and Picklo (1990)
-    for sample in np.arange(1, len(bias_temp)):
-        bias_temp[sample] = -b[sample] * bias_temp[sample - 1] + a[sample] * (corr_temp[sample] - corr_temp[sample - 1])
-    corr_temp = interp(raw_seconds, raw_temp, raw_seconds + 0.9)
-    corr_temp = pandas_fill(corr_temp)
+    # Temperature probe's thermal lag is corrected by advancing temperature 0.9 s. The recursive probe correction
+    # (alpha = 0.05 * spd ** -0.83, tau = 375) is not applied to the data, so is not computed
+    corr_temp = interp(raw_seconds, raw_temp, raw_seconds + 0.9, low_memory=low_memory)
+    corr_temp = backfill(corr_temp)
 
     # Estimate effective temperature of the conductivity measurement (long thermal lag)
-    alpha = 0.18 * spd ** (-1.10)
-    tau = 179
-    bias_long = np.full_like(corr_temp, 0)
-    a = 4 * fn * alpha * tau / (1 + 4 * fn * tau)  # Lueck and Picklo (1990)
-    b = 1 - 2 * a / alpha  # Lueck and Picklo (1990)
-    for sample in np.arange(1, len(bias_long)):
-        bias_long[sample] = -b[sample] * bias_long[sample - 1] + a[sample] * (corr_temp[sample] - corr_temp[sample - 1])
+    # alpha = 0.18 * spd ** (-1.10), tau = 179
+    # a = 4 * fn * alpha * tau / (1 + 4 * fn * tau), b = 1 - 2 * a / alpha  Lueck and Picklo (1990)
+    a_long, b_long = lag_coefficients(spd, fn, 0.18, -1.10, 179)
 
     # Estimate effective temperature of the conductivity measurement (short thermal lag)
-    alpha = 0.23 * spd ** (-0.82)
-    tau = 27.15 * spd ** (-0.58)
-    bias_short = np.full_like(corr_temp, 0)
-    a = 4 * fn * alpha * tau / (1 + 4 * fn * tau)  # Lueck and Picklo (1990)
-    b = 1 - 2 * a / alpha  # Lueck and Picklo (1990)
-    for sample in np.arange(1, len(bias_short)):
-        bias_short[sample] = -b[sample] * bias_short[sample - 1] + a[sample] * (
-                corr_temp[sample] - corr_temp[sample - 1])
-
-    corr_sal = gsw.SP_from_C(ds['conductivity'].values, corr_temp - bias_long - bias_short,
-                             ds['pressure'].values)
+    # alpha = 0.23 * spd ** (-0.82), tau = 27.15 * spd ** (-0.58)
+    a_short, b_short = lag_coefficients(spd, fn, 0.23, -0.82, 27.15, -0.58)
+    del spd, vert_spd
+
+    if workers and workers > 1:
+        if segment_by in list(ds.variables):
+            segment_ids = ds[segment_by].values
+        else:
+            _log.warning(f"{segment_by} not found in dataset. Splitting thermal lag correction at arbitrary samples")
+            segment_ids = np.arange(len(corr_temp))
+        bounds = segment_bounds(segment_ids, workers)
+        _log.info(f"Thermal lag correction on {len(bounds) - 1} segments split by {segment_by}")
+        bias_long, bias_short = segmented_lag_bias([(a_long, b_long), (a_short, b_short)], corr_temp, bounds,
+                                                   workers)
+    else:
+        bias_long = lag_bias(a_long, b_long, corr_temp)
+        bias_short = lag_bias(a_short, b_short, corr_temp)
+    del a_long, b_long, a_short, b_short
+
+    cell_temp = corr_temp - bias_long
+    del bias_long
+    cell_temp -= bias_short
+    del bias_short
+    corr_sal = thermo.practical_salinity(temperature=cell_temp)
+    del cell_temp
     corr_temp[np.isnan(ds['temperature'].values)] = np.nan
     corr_sal[np.isnan(ds['salinity'].values)] = np.nan
 
     ds['temperature'].values = corr_temp
     ds['salinity'].values = corr_sal
 
-    sa = gsw.SA_from_SP(ds['salinity'], ds['pressure'], ds['longitude'], ds['latitude'])
-    ct = gsw.CT_from_t(sa, ds['temperature'], ds['pressure'])
-    ds['potential_density'].values = 1000 + gsw.density.sigma0(sa, ct)
-    ds['density'] = gsw.density.rho(ds.salinity, ds.temperature, ds.pressure)
+    if derived:
+        ds = set_potential_density(ds, thermo)
+        ds = set_density(ds, thermo)
     rbr_str = ("Corrected following Thermal lag from Thermal Inertia of Conductivity Cells: Observations with a "
                "Sea-Bird Cell Rolf G. Lueck and James J. Picklo"
                " https://doi.org/10.1175/1520-0426(1990)007<0756:TIOCCO>2.0.CO;2 as implemented by "
@@ -1,22 +1,52 @@
+import resource
 import numpy as np
 import re
-from votoutils.glider.post_process_optics import betasw_ZHH2009
-from votoutils.utilities.geocode import filter_territorial_data
-from votoutils.glider.post_process_ctd import salinity_pressure_correction, correct_rbr_lag
+from collections import OrderedDict, namedtuple
+from votoutils.glider.post_process_optics import betasw_ZHH2009, betasw_lookup
+from votoutils.utilities.geocode import territorial_mask, comment as territorial_comment
+from votoutils.glider.post_process_ctd import salinity_pressure_correction, correct_rbr_lag, set_density, \
+    set_potential_density
+from votoutils.glider.thermodynamics import ThermoContext, threaded_elementwise
 import logging
 _log = logging.getLogger(__name__)
 
+# A named set of samples to set to NaN in some variables, with an optional comment to append to their attributes
+PendingMask = namedtuple("PendingMask", "mask variables comment")
 
-def calculate_bbp(ds, beam_angle=117):
+
+def backscatter_channels(ds):
+    """
+    Scaled backscatter variables in ds, e.g. backscatter_scaled or backscatter_scaled_470, and their wavelengths in nm.
+    The wavelength is read from the standard_name, or from the variable name if the standard_name has none
+    """
+    channels = {}
+    for var_name in list(ds):
+        # QC variables such as backscatter_scaled_qc share the name prefix and a standard_name with the wavelength
+        if var_name.endswith("_qc") or var_name.endswith("_qc_tests"):
+            continue
+        if not re.fullmatch(r'backscatter_scaled(_\d+)?', var_name):
+            continue
+        wavelength = re.findall(r'\d+', ds[var_name].attrs.get("standard_name", "")) or re.findall(r'\d+', var_name)
+        if not wavelength:
+            _log.warning(f"No wavelength found for {var_name}. Skipping")
+            continue
+        channels[var_name] = int(wavelength[0])
+    return channels
+
+
+def bbp_name(channel, wavelength):
+    if channel == "backscatter_scaled":
+        return "particulate_backscatter"
+    return f"particulate_backscatter_{wavelength}"
+
+
+def calculate_bbp(ds, beam_angle=117, lookup=False, low_memory=False):
     # https://oceanobservatories.org/wp-content/uploads/2015/10/1341-00540_Data_Product_SPEC_FLUBSCT_OOI.pdf
+    # lookup: interpolate seawater scattering from a cached (temperature, salinity) table, see betasw_lookup
+    # low_memory: compute b_bp in place in float32, ample for the ~1e-5 m-1 resolution of the sensors
+    # All backscatter channels are processed in one pass. Seawater scattering is evaluated with a wavelength axis
+    # broadcast against the samples, so terms that depend only on temperature and salinity are computed once
     _log.info("processing backscatter")
-    temperature = ds["temperature"].values
-    salinity = ds["salinity"].values
-    beta_total = ds["backscatter_scaled"].values
-    backscatter_str = ds["backscatter_scaled"].attrs["standard_name"]
-    wavelength = int(re.findall(r'\d+', backscatter_str)[0])
-    beta_sw, __, __ = betasw_ZHH2009(temperature, salinity, wavelength, beam_angle)
-    beta_p = beta_total - beta_sw
     if beam_angle == 117:
         chi_p = 1.08  # For 117* angle (Sullivan & Twardowski, 2009)
     elif beam_angle == 140:
@@ -24,18 +54,41 @@ def calculate_bbp(ds, beam_angle=117):
     else:
         _log.error(f"Incompatible beam_angle. Allowed values are 117 or 140")
         return
-    bbp_val = 2 * np.pi * chi_p * beta_p  # in m-1
-    bbp = ds["backscatter_scaled"].copy()
-    bbp.values = bbp_val
-    bbp.attrs = {"units": "m^{-1}",
-                 'observation_type': 'calculated',
-                 'standard_name': f'{wavelength}_nm_scattering_of_particles_integrated_over_the_backwards hemisphere',
-                 "long_name": f"{wavelength} nm b_bp: scattering of particles integrated over the backwards hemisphere",
-                 "processing": "Particulate backscatter b_bp calculated following methods in the Ocean Observatories Initiative document "
-                               "DATA PRODUCT SPECIFICATION FOR OPTICAL BACKSCATTER (RED WAVELENGTHS) Version 1-05 "
-                               "Document Control Number 1341-00540 2014-05-28. Downloaded from "
-                               "https://oceanobservatories.org/wp-content/uploads/2015/10/1341-00540_Data_Product_SPEC_FLUBSCT_OOI.pdf"}
-    ds["particulate_backscatter"] = bbp
+    channels = backscatter_channels(ds)
+    if not channels:
+        _log.warning("No backscatter channels found")
+        return ds
+    temperature = ds["temperature"].values
+    salinity = ds["salinity"].values
+    wavelengths = np.array(list(channels.values()))
+    if lookup:
+        beta_sw, __, __ = betasw_lookup(temperature, salinity, wavelengths, beam_angle)
+    else:
+        def channel_betasw(temperature_chunk, salinity_chunk):
+            betasw, __, __ = betasw_ZHH2009(temperature_chunk, salinity_chunk, wavelengths[:, np.newaxis],
+                                            beam_angle)
+            return tuple(betasw)
+
+        beta_sw = threaded_elementwise(channel_betasw, temperature, salinity)
+    for (channel, wavelength), channel_beta_sw in zip(channels.items(), beta_sw):
+        _log.info(f"calculating {wavelength} nm particulate backscatter from {channel}")
+        if low_memory:
+            bbp_val = ds[channel].values.astype(np.float32)
+            bbp_val -= channel_beta_sw
+            bbp_val *= 2 * np.pi * chi_p  # in m-1
+        else:
+            beta_p = ds[channel].values - channel_beta_sw
+            bbp_val = 2 * np.pi * chi_p * beta_p  # in m-1
+        bbp = ds[channel].copy(data=bbp_val)
+        bbp.attrs = {"units": "m^{-1}",
+                     'observation_type': 'calculated',
+                     'standard_name': f'{wavelength}_nm_scattering_of_particles_integrated_over_the_backwards hemisphere',
+                     "long_name": f"{wavelength} nm b_bp: scattering of particles integrated over the backwards hemisphere",
+                     "processing": "Particulate backscatter b_bp calculated following methods in the Ocean Observatories Initiative document "
+                                   "DATA PRODUCT SPECIFICATION FOR OPTICAL BACKSCATTER (RED WAVELENGTHS) Version 1-05 "
+                                   "Document Control Number 1341-00540 2014-05-28. Downloaded from "
+                                   "https://oceanobservatories.org/wp-content/uploads/2015/10/1341-00540_Data_Product_SPEC_FLUBSCT_OOI.pdf"}
+        ds[bbp_name(channel, wavelength)] = bbp
 
     return ds
 
@@ -46,22 +99,55 @@ def vertical_distance_from_altimeter(altimeter, pitch_glider, roll):
     return vertical_distance
 
 
-def process_altimeter(ds):
+def register_mask(masks, name, mask, variables, comment=None):
+    """Add a mask to the registry of masks that apply_masks applies in a single pass"""
+    masks[name] = PendingMask(np.asarray(mask, dtype=bool), list(variables), comment)
+    return masks
+
+
+def apply_masks(ds, masks):
+    """
+    Apply all registered masks in one pass. The masks that affect each variable are combined, so each variable is
+    written once however many masks touch it
+    """
+    masks_by_variable = OrderedDict()
+    for name, pending in masks.items():
+        variables = [var_name for var_name in pending.variables if var_name in list(ds)]
+        _log.info(f"mask {name}: {int(pending.mask.sum())} samples set to NaN in {', '.join(variables)}")
+        for var_name in variables:
+            masks_by_variable.setdefault(var_name, []).append(pending)
+    for var_name, pendings in masks_by_variable.items():
+        combined = pendings[0].mask.copy()
+        for pending in pendings[1:]:
+            combined |= pending.mask
+        ds[var_name].values[combined] = np.nan
+        for pending in pendings:
+            if pending.comment:
+                ds[var_name].attrs["comment"] = f'{ds[var_name].attrs["comment"]}. {pending.comment}'
+    return ds
+
+
+def process_altimeter(ds, masks=None, low_memory=False):
     """
     From the seaexploer manual: the angle of the altimeter is 20 degrees, such that it is vertical when the glider
     is pitched at 20 degrees during the dive.
     :param ds:
+    :param masks: optional mask registry. If given, non-positive altimeter readings are registered as a mask instead
+     of being removed here
+    :param low_memory: compute the distance in float32, which resolves millimetres over the altimeter range
     :return: ds with additional bathymetry variable
     """
     if "altimeter" not in list(ds):
         _log.warning("No altimeter data found")
         return ds
     altim_raw = ds["altimeter"].values
-    altim = altim_raw.copy()
-    altim[altim_raw <= 0] = np.nan
-    bathy_from_altimeter = vertical_distance_from_altimeter(altim, ds["pitch"].values, ds["roll"].values)
-    vertical_distance_to_seafloor = ds["altimeter"].copy()
-    vertical_distance_to_seafloor.values = bathy_from_altimeter
+    if low_memory:
+        bathy_from_altimeter = vertical_distance_from_altimeter(altim_raw.astype(np.float32),
+                                                                ds["pitch"].values.astype(np.float32),
+                                                                ds["roll"].values.astype(np.float32))
+    else:
+        bathy_from_altimeter = vertical_distance_from_altimeter(altim_raw, ds["pitch"].values, ds["roll"].values)
+    vertical_distance_to_seafloor = ds["altimeter"].copy(data=bathy_from_altimeter)
     attrs = vertical_distance_to_seafloor.attrs
     attrs["long_name"] = "vertical distance from glider to seafloor"
     attrs["standard_name"] = "vertical_distance_to_seafloor"
@@ -70,6 +156,10 @@ def process_altimeter(ds):
                        "is pitched downwards at 20 degrees."
     vertical_distance_to_seafloor.attrs = attrs
     ds["vertical_distance_to_seafloor"] = vertical_distance_to_seafloor
+    if masks is None:
+        ds["vertical_distance_to_seafloor"].values[altim_raw <= 0] = np.nan
+    else:
+        register_mask(masks, "altimeter_no_bottom", altim_raw <= 0, ["vertical_distance_to_seafloor"])
     return ds
 
 
@@ -83,30 +173,187 @@ def fix_variables(ds):
     return ds
 
 
-def nan_bad_depths(ds):
-    ds['depth'][ds['depth'] > int(ds['depth'].attrs['valid_max'])] = np.nan
-    ds['pressure'][ds['pressure'] > int(ds['pressure'].attrs['valid_max'])] = np.nan
+def nan_bad_depths(ds, masks=None):
+    """Remove depth and pressure above their valid_max, or register the masks if a mask registry is given"""
+    masks_here = OrderedDict() if masks is None else masks
+    for var_name in ["depth", "pressure"]:
+        register_mask(masks_here, f"{var_name}_above_valid_max",
+                      ds[var_name].values > int(ds[var_name].attrs['valid_max']), [var_name])
+    if masks is None:
+        ds = apply_masks(ds, masks_here)
     return ds
 
 
-def nan_bad_locations(ds):
-    ds['longitude'].values[ds['longitude_qc'] > 3] = np.nan
-    ds['latitude'].values[ds['latitude_qc'] > 3] = np.nan
+def nan_bad_locations(ds, masks=None):
+    """Remove positions that failed QC, or register the masks if a mask registry is given"""
+    masks_here = OrderedDict() if masks is None else masks
+    for var_name in ["longitude", "latitude"]:
+        register_mask(masks_here, f"{var_name}_qc_fail", ds[f"{var_name}_qc"].values > 3, [var_name])
+    if masks is None:
+        ds = apply_masks(ds, masks_here)
     return ds
 
 
-def post_process(ds):
+# A derived variable of the timeseries: the variables it is computed from, a function of the dataset giving the names
+# of the variables it produces, and a function that computes them on a DerivedTimeseries
+DerivedVariable = namedtuple("DerivedVariable", "inputs outputs compute")
+derived_variables = OrderedDict()
+
+
+def register_derived_variable(name, inputs, compute, outputs=None):
+    """
+    Add a derived variable to the registry. compute is called with the DerivedTimeseries and adds the outputs to its
+    dataset. outputs defaults to the single variable name
+    """
+    derived_variables[name] = DerivedVariable(tuple(inputs), outputs or (lambda ds: [name]), compute)
+
+
+register_derived_variable("potential_density", ("salinity", "temperature", "pressure", "longitude", "latitude"),
+                          lambda derived: set_potential_density(derived.ds, derived.thermo))
+register_derived_variable("density", ("salinity", "temperature", "pressure"),
+                          lambda derived: set_density(derived.ds, derived.thermo))
+register_derived_variable("vertical_distance_to_seafloor", ("altimeter", "pitch", "roll"),
+                          lambda derived: process_altimeter(derived.ds, derived.masks, low_memory=derived.low_memory))
+register_derived_variable("particulate_backscatter", ("temperature", "salinity"),
+                          lambda derived: calculate_bbp(derived.ds, lookup=derived.bbp_lookup,
+                                                          low_memory=derived.low_memory),
+                          lambda ds: [bbp_name(channel, wavelength) for channel, wavelength in
+                                      backscatter_channels(ds).items()])
+
+
+class DerivedTimeseries:
+    """
+    Derived variables of a glider timeseries from the registry, each computed on first access. Index it like the
+    dataset: derived["density"] computes density if it is still pending and returns ds["density"]. Call materialize
+    to compute everything that is pending, e.g. before writing the timeseries to file
+    """
+
+    def __init__(self, ds, thermo=None, masks=None, low_memory=False, lazy=True, bbp_lookup=False):
+        """
+        :param thermo: optional ThermoContext of ds, shared with the processing steps that came before
+        :param masks: mask registry. Masks registered for a derived variable are applied as soon as it is computed
+         if lazy, otherwise they are left to the caller's apply_masks
+        :param lazy: variables in ds with the name of a pending derived variable hold values from before processing.
+         If lazy, they are dropped from ds, keeping their attributes and encoding for the computed variable
+        :param bbp_lookup: compute particulate backscatter with the seawater scattering lookup table, see calculate_bbp
+        """
+        self.ds = ds
+        self.thermo = thermo or ThermoContext(ds)
+        self.masks = OrderedDict() if masks is None else masks
+        self.low_memory = low_memory
+        self.lazy = lazy
+        self.bbp_lookup = bbp_lookup
+        self._pending = OrderedDict()
+        for name, definition in derived_variables.items():
+            missing = [var_name for var_name in definition.inputs if var_name not in list(ds)]
+            outputs = definition.outputs(ds)
+            if missing or not outputs:
+                _log.info(f"derived variable {name} not available. Missing {', '.join(missing) or 'outputs'}")
+                continue
+            for output in outputs:
+                self._pending[output] = name
+        self._previous = {}
+        if lazy:
+            stale = [var_name for var_name in self._pending if var_name in list(ds)]
+            self._previous = {var_name: (ds[var_name].attrs, ds[var_name].encoding) for var_name in stale}
+            self.ds = ds.drop_vars(stale)
+            self.thermo.ds = self.ds
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def compute(self, name):
+        """Compute the derived variable that produces the variable name, with any other outputs of the same
+        definition"""
+        definition_name = self._pending[name]
+        outputs = [output for output, source in self._pending.items() if source == definition_name]
+        _log.info(f"computing derived variable {definition_name}")
+        self.ds = derived_variables[definition_name].compute(self) or self.ds
+        for output in outputs:
+            del self._pending[output]
+            if output in self._previous:
+                attrs, encoding = self._previous.pop(output)
+                self.ds[output].attrs = {**attrs, **self.ds[output].attrs}
+                self.ds[output].encoding = {**encoding, **self.ds[output].encoding}
+        if self.lazy:
+            masks = OrderedDict()
+            for mask_name, pending in self.masks.items():
+                variables = [var_name for var_name in pending.variables if var_name in outputs]
+                if variables:
+                    masks[mask_name] = pending._replace(variables=variables)
+            self.ds = apply_masks(self.ds, masks)
+        return self.ds
+
+    def __getitem__(self, name):
+        if name in self._pending:
+            self.compute(name)
+        return self.ds[name]
+
+    def __contains__(self, name):
+        return name in self._pending or name in list(self.ds)
+
+    def materialize(self):
+        """Compute all pending derived variables
+        :return: the dataset with every derived variable"""
+        while self._pending:
+            self.compute(next(iter(self._pending)))
+        return self.ds
+
+
+def time_is_monotonic(ds):
+    time = ds["time"].values
+    return not np.any(~(time[1:] >= time[:-1]))
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _post_process(ds, workers, low_memory, lazy, bbp_lookup):
+    """Corrections and masks shared by post_process and post_process_lazy
+    :return: DerivedTimeseries of the post processed dataset"""
     _log.info("start post process")
-    ds = salinity_pressure_correction(ds)
-    ds = correct_rbr_lag(ds)
-    ds = process_altimeter(ds)
-    ds = filter_territorial_data(ds)
-    if "backscatter_scaled" in list(ds):
-        ds = calculate_bbp(ds)
+    # sort once, up front, so every step sees the data in time order
+    if not time_is_monotonic(ds):
+        _log.info("sorting dataset by time")
+        ds = ds.sortby("time")
+    masks = OrderedDict()
+    thermo = ThermoContext(ds)
+    ds = salinity_pressure_correction(ds, thermo=thermo, low_memory=low_memory)
+    ds = correct_rbr_lag(ds, workers=workers, thermo=thermo, low_memory=low_memory, derived=False)
+    derived = DerivedTimeseries(ds, thermo=thermo, masks=masks, low_memory=low_memory, lazy=lazy,
+                                bbp_lookup=bbp_lookup)
+    ds = derived.ds if lazy else derived.materialize()
+    territorial_samples, territorial_variables = territorial_mask(ds, list(ds) + derived.pending)
+    if territorial_samples is not None:
+        register_mask(masks, "territorial_seas", territorial_samples, territorial_variables, territorial_comment)
     ds = fix_variables(ds)
-    ds = nan_bad_depths(ds)
-    ds = nan_bad_locations(ds)
-    ds = ds.sortby("time")
-    _log.info("complete post process")
-    return ds
+    ds = nan_bad_depths(ds, masks)
+    ds = nan_bad_locations(ds, masks)
+    derived.ds = apply_masks(ds, masks)
+    _log.info(f"complete post process. Peak memory {peak_memory_mb():.0f} MB")
+    return derived
+
 
+def post_process(ds, workers=None, low_memory=False, bbp_lookup=False):
+    """
+    :param workers: optional number of processes for the thermal lag correction
+    :param low_memory: do the corrections in place or in float32 working buffers where precision allows, to bound
+     peak memory on small machines
+    :param bbp_lookup: interpolate seawater scattering for particulate backscatter from a cached lookup table instead
+     of the exact formula. Faster on long missions, agrees to a relative error below 1e-6
+    :return: post processed dataset
+    """
+    return _post_process(ds, workers, low_memory, False, bbp_lookup).ds
+
+
+def post_process_lazy(ds, workers=None, low_memory=False, bbp_lookup=False):
+    """
+    post_process, leaving the derived variables (density, potential_density, vertical_distance_to_seafloor and
+    particulate backscatter) uncomputed. Each is computed on first access, from the final, masked core variables, so
+    density and potential_density are also NaN where pressure or position were removed. Parameters as post_process
+    :return: DerivedTimeseries of the post processed dataset. Call materialize on it to get the full dataset
+    """
+    return _post_process(ds, workers, low_memory, True, bbp_lookup)
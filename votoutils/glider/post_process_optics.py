@@ -1,4 +1,10 @@
+import pathlib
+import tempfile
 import numpy as np
+import logging
+
+_log = logging.getLogger(__name__)
+
 
 def betasw_ZHH2009(Tc, S, wavelength=700, theta=117, delta=0.039):
     # Xiaodong Zhang, Lianbo Hu, and Ming-Xia He (2009), Scatteirng by pure
@@ -150,3 +156,113 @@ def betasw_ZHH2009(Tc, S, wavelength=700, theta=117, delta=0.039):
     betasw = beta90sw * (1 + ((np.cos(rad)) ** 2) * (1 - delta) / (1 + delta))
 
     return betasw, beta90sw, bsw
+
+
+betasw_lut_dir = "/data/tmp/betasw_lut"
+# Grid of the lookup tables. Spans the temperature and salinity gross ranges of the QC configs
+lut_temperature = np.linspace(-2.5, 40, 851)
+lut_salinity = np.linspace(0, 45, 901)
+_betasw_luts = {}
+
+
+def _bilinear_weights(x, grid):
+    step = grid[1] - grid[0]
+    position = (x - grid[0]) / step
+    with np.errstate(invalid="ignore"):
+        index = np.clip(np.floor(position).astype(np.int64), 0, len(grid) - 2)
+    return index, position - index
+
+
+def _lut_cells(Tc, S):
+    """Flat index of the lower corner of each sample's grid cell, and the interpolation weights"""
+    i, wt = _bilinear_weights(Tc, lut_temperature)
+    j, ws = _bilinear_weights(S, lut_salinity)
+    return i * len(lut_salinity) + j, wt, ws
+
+
+def _interpolate_lut(lut, Tc, S, cells=None):
+    corner, wt, ws = cells or _lut_cells(Tc, S)
+    # gather the four corners of each sample's cell from the flattened table
+    flat = lut.reshape(-1)
+    upper = corner + lut.shape[1]
+    with np.errstate(invalid="ignore"):
+        low_t = flat[corner] + ws * (flat[corner + 1] - flat[corner])
+        high_t = flat[upper] + ws * (flat[upper + 1] - flat[upper])
+        return low_t + wt * (high_t - low_t)
+
+
+def build_betasw_lut(wavelength, theta, delta):
+    """
+    beta90sw of betasw_ZHH2009 on the (temperature, salinity) grid, and the maximum relative error of bilinear
+    interpolation, measured against the exact formula at the centre and edge midpoints of every grid cell
+    """
+    temperature, salinity = np.meshgrid(lut_temperature, lut_salinity, indexing="ij")
+    __, lut, __ = betasw_ZHH2009(temperature, salinity, wavelength, theta, delta)
+    mid_t = (lut_temperature[1:] + lut_temperature[:-1]) / 2
+    mid_s = (lut_salinity[1:] + lut_salinity[:-1]) / 2
+    max_error = 0
+    for check_t, check_s in ((mid_t, mid_s), (lut_temperature, mid_s), (mid_t, lut_salinity)):
+        temperature, salinity = np.meshgrid(check_t, check_s, indexing="ij")
+        __, exact, __ = betasw_ZHH2009(temperature, salinity, wavelength, theta, delta)
+        approx = _interpolate_lut(lut, temperature, salinity)
+        max_error = max(max_error, np.nanmax(np.abs(approx - exact) / np.abs(exact)))
+    return lut, max_error
+
+
+def load_betasw_lut(wavelength, theta, delta, lut_dir=betasw_lut_dir):
+    """Lookup table of beta90sw for this wavelength, angle and depolarization ratio. Built once, then read from
+    lut_dir. If lut_dir is not writable the table is only kept in memory"""
+    key = (float(wavelength), float(theta), float(delta))
+    if key in _betasw_luts:
+        return _betasw_luts[key]
+    lut_path = pathlib.Path(lut_dir) / f"betasw_{wavelength}nm_{theta}deg_{delta}.npz"
+    grid_shape = (len(lut_temperature), len(lut_salinity))
+    lut = None
+    if lut_path.exists():
+        with np.load(lut_path) as stored:
+            if stored["beta90sw"].shape == grid_shape and np.array_equal(stored["temperature"], lut_temperature) \
+                    and np.array_equal(stored["salinity"], lut_salinity):
+                lut, max_error = stored["beta90sw"], float(stored["max_relative_error"])
+    if lut is None:
+        lut, max_error = build_betasw_lut(wavelength, theta, delta)
+        _log.info(f"built betasw lookup table for {wavelength} nm, max relative error {max_error:.2e}")
+        try:
+            lut_path.parent.mkdir(parents=True, exist_ok=True)
+            # unique temporary name, so processes building the same table at once do not write into one file
+            with tempfile.NamedTemporaryFile(dir=lut_path.parent, suffix=".tmp", delete=False) as fout:
+                np.savez(fout, beta90sw=lut, temperature=lut_temperature, salinity=lut_salinity,
+                         max_relative_error=max_error)
+            pathlib.Path(fout.name).replace(lut_path)
+        except OSError as err:
+            _log.warning(f"Could not cache betasw lookup table in {lut_dir}: {err}")
+    _betasw_luts[key] = (lut, max_error)
+    return lut, max_error
+
+
+def betasw_lookup(Tc, S, wavelength=700, theta=117, delta=0.039, lut_dir=betasw_lut_dir):
+    """
+    betasw_ZHH2009 by bilinear interpolation in a precomputed (temperature, salinity) table. Relative error against
+    the exact formula is below 1e-6 on the default grid, and the bound for each table is logged when it is built.
+    Samples outside the grid are evaluated with the exact formula
+    :param wavelength: wavelength in nm, or a sequence of wavelengths that share the grid cells and weights
+    :return: betasw, beta90sw, bsw as betasw_ZHH2009. With a sequence of wavelengths, each has a leading wavelength axis
+    """
+    Tc = np.asarray(Tc, dtype=np.float64)
+    S = np.asarray(S, dtype=np.float64)
+    wavelengths = np.atleast_1d(wavelength)
+    cells = _lut_cells(Tc, S)
+    outside = (Tc < lut_temperature[0]) | (Tc > lut_temperature[-1]) | (S < lut_salinity[0]) | (S > lut_salinity[-1])
+    missing = ~np.isfinite(Tc) | ~np.isfinite(S)
+    beta90sw = np.empty((len(wavelengths),) + Tc.shape)
+    for k, channel_wavelength in enumerate(wavelengths.tolist()):
+        lut, __ = load_betasw_lut(channel_wavelength, theta, delta, lut_dir)
+        beta90sw[k] = _interpolate_lut(lut, Tc, S, cells)
+        if outside.any():
+            __, beta90sw[k][outside], __ = betasw_ZHH2009(Tc[outside], S[outside], channel_wavelength, theta, delta)
+        beta90sw[k][missing] = np.nan
+    if np.ndim(wavelength) == 0:
+        beta90sw = beta90sw[0]
+    rad = theta * np.pi / 180
+    bsw = 8 * np.pi / 3 * beta90sw * (2 + delta) / (1 + delta)
+    betasw = beta90sw * (1 + ((np.cos(rad)) ** 2) * (1 - delta) / (1 + delta))
+    return betasw, beta90sw, bsw
@@ -6,11 +6,12 @@ import yaml
 import numpy as np
 import polars as pl
 import xarray as xr
-from votoutils.utilities.geocode import get_seas_merged_nav_nc
+from votoutils.utilities.geocode import get_seas_merged_nav_nc, add_sample_basins
 from votoutils.glider.post_process_dataset import post_process
 from votoutils.utilities.utilities import encode_times, set_best_dtype
 from votoutils.fixers.file_operations import clean_nrt_bad_files
 from votoutils.qc.flag_qartod import flagger
+from votoutils.qc.profile_qartod import flag_profiles
 script_dir = pathlib.Path(__file__).parent.parent.parent.absolute()
 parent_dir = script_dir.parents[0]
 qc_dir = parent_dir / "voto_glider_qc"
@@ -30,41 +31,71 @@ def safe_delete(directories):
             shutil.rmtree(directory)
 
 
-def set_profile_numbers(ds):
-    ds["dive_num"] = np.around(ds["dive_num"]).astype(int)
-    df = ds.to_pandas()
-    df["profile_index"] = 1
-    deepest_points = []
-    dive_nums = np.unique(df.dive_num)
-    for num in dive_nums:
-        df_dive = df[df.dive_num == num]
-        if np.isnan(df_dive.pressure).all():
-            deep_inflect = df_dive.index[int(len(df_dive)/2)]
-        else:
-            deep_inflect = df_dive[df_dive.pressure == df_dive.pressure.max()].index.values[0]
-        deepest_points.append(deep_inflect)
+def label_ranges(time, positions):
+    """
+    First and last row of the time label at each position, as pandas label slicing df.loc[label] selects them.
+    Rows that share a time with the row at a position are included if time is monotonic
+    """
+    if np.all(time[1:] >= time[:-1]):
+        return np.searchsorted(time, time[positions], "left"), np.searchsorted(time, time[positions], "right") - 1
+    return positions, positions
+
 
-    previous_deep_inflect = deepest_points[0]
-    df.loc[df.index[0]:previous_deep_inflect, "profile_index"] = 1
-    num = 0
-    for i, deep_inflect in enumerate(deepest_points[1:]):
-        num = i + 1
-        df_deep_to_deep = df.loc[previous_deep_inflect: deep_inflect]
-        if np.isnan(df_deep_to_deep.pressure).all():
-            shallow_inflect = df_deep_to_deep.index[int(len(df_deep_to_deep)/2)]
-        else:
-            shallow_inflect = df_deep_to_deep[df_deep_to_deep.pressure == df_deep_to_deep.pressure.min()].index.values[0]
-        df.loc[previous_deep_inflect:shallow_inflect, "profile_index"] = num * 2
-        df.loc[shallow_inflect:deep_inflect, "profile_index"] = num * 2+1
-        previous_deep_inflect = deep_inflect
-    df.loc[previous_deep_inflect:df.index[-1], "profile_index"] = num * 2 + 2
+def grouped_first_extreme(groups, pressure, sizes, largest=False):
+    """
+    Row of the first minimum (or maximum) pressure of each group, in groups of rows sorted by group. For groups with
+    no pressure, the middle row of the group
+    :param groups: group of each row, non-decreasing
+    :param pressure: pressure of each row
+    :param sizes: number of rows in each group
+    :return: index into the rows of each group's extreme
+    """
+    rows = np.arange(len(groups))
+    order = np.lexsort((rows, -pressure if largest else pressure, groups))
+    starts = np.cumsum(sizes) - sizes
+    extreme = order[starts]
+    no_pressure = np.isnan(pressure[extreme])
+    extreme[no_pressure] = starts[no_pressure] + sizes[no_pressure] // 2
+    return extreme
 
-    df["profile_direction"] = 1
-    df.loc[df.profile_index % 2 == 0, "profile_direction"] = -1
-    ds["profile_index"] = df.dive_num.copy()
-    ds["profile_direction"] = df.dive_num.copy()
-    ds["profile_index"].values = df.profile_index
-    ds["profile_direction"].values = df.profile_direction
+
+def set_profile_numbers(ds):
+    """
+    Split the mission into profiles between the deepest point of each dive and the shallowest point between
+    consecutive deepest points. Descents have odd profile_index, ascents even
+    """
+    ds["dive_num"] = np.around(ds["dive_num"]).astype(int)
+    dive_num = ds["dive_num"].values
+    pressure = ds["pressure"].values.astype(float)
+    time = ds["time"].values
+    # deepest point of each dive, or its middle sample if it has no pressure
+    by_dive = np.argsort(dive_num, kind="stable")
+    __, dive_sizes = np.unique(dive_num, return_counts=True)
+    deepest_points = by_dive[grouped_first_extreme(dive_num[by_dive], pressure[by_dive], dive_sizes, largest=True)]
+    deep_first, deep_last = label_ranges(time, deepest_points)
+    # shallowest point between consecutive deepest points, both included, or the middle sample if it has no pressure
+    window_starts, window_ends = deep_first[:-1], deep_last[1:]
+    window_sizes = window_ends - window_starts + 1
+    if np.any(window_sizes < 1):
+        raise IndexError("deepest points of the dives are not in time order")
+    window_num = np.repeat(np.arange(len(window_sizes)), window_sizes)
+    window_rows = window_starts[window_num] + np.arange(window_sizes.sum()) - np.repeat(
+        np.cumsum(window_sizes) - window_sizes, window_sizes)
+    shallowest_points = window_rows[grouped_first_extreme(window_num, pressure[window_rows], window_sizes)]
+    shallow_first, __ = label_ranges(time, shallowest_points)
+    # Profiles run from the start, to each shallowest point, to each deepest point. Every sample takes the profile
+    # that starts last at or before it, so a sample on a boundary belongs to the profile that starts there
+    num = len(deepest_points) - 1
+    profile_starts = np.empty(2 * num + 2, dtype=int)
+    profile_starts[0] = 0
+    profile_starts[1:-1:2] = deep_first[:-1]
+    profile_starts[2:-1:2] = shallow_first
+    profile_starts[-1] = deep_first[-1]
+    profile_index = np.arange(1, 2 * num + 3)[np.searchsorted(profile_starts, np.arange(len(time)), "right") - 1]
+    profile_direction = np.ones(len(time), dtype=int)
+    profile_direction[profile_index % 2 == 0] = -1
+    ds["profile_index"] = (ds["dive_num"].dims, profile_index)
+    ds["profile_direction"] = (ds["dive_num"].dims, profile_direction)
     ds["profile_index"].attrs = {'long_name': 'profile index',
                                  'units': '1',
                                  'sources': 'pressure, time, dive_num'}
@@ -125,7 +156,9 @@ def proc_pyglider_l0(glider, mission, kind, input_dir, output_dir):
     int_vars = ["angular_cmd", "ballast_cmd", "linear_cmd", "nav_state", "security_level", "dive_num",
                 "desired_heading",]
     ds = xr.open_dataset(outname)
-    ds = flagger(ds)
+    # nrt missions grow by a few dives each run, so reuse QC flags from the previous run where inputs are unchanged
+    qc_cache = f"/data/tmp/qc_cache/SEA{str(glider)}_M{str(mission)}.npz" if kind == 'sub' else None
+    ds = flagger(ds, qc_cache=qc_cache)
     ds_variables = list(ds)
     for var in ds_variables:
         if var in int_vars or var[-2:] == "qc":
@@ -133,8 +166,10 @@ def proc_pyglider_l0(glider, mission, kind, input_dir, output_dir):
         elif var[-3:] == "raw":
             ds[var] = np.around(ds[var])
     ds = post_process(ds)
+    ds = add_sample_basins(ds)
     ds = set_best_dtype(ds)
     ds = set_profile_numbers(ds)
+    ds = flag_profiles(ds)
     ds = encode_times(ds)
     ds.to_netcdf(outname)
 
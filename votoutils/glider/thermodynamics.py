@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import gsw
+import numpy as np
+import logging
+
+_log = logging.getLogger(__name__)
+
+# Samples per chunk. Keeps the inputs, output and temporaries of a gsw call on one chunk within the CPU cache
+chunk_samples = 2 ** 15
+# Arrays smaller than this are evaluated with a single direct call
+min_threaded_samples = 2 ** 18
+
+
+def threaded_elementwise(function, *args, workers=None, chunk_size=chunk_samples, min_size=min_threaded_samples):
+    """
+    Evaluate an element-wise function, e.g. a gsw function, over 1D arrays in chunks on a thread pool. gsw and numpy
+    release the GIL inside their loops, so chunks run in parallel. Each chunk is written into a preallocated output,
+    so results are identical to the direct call
+    :param function: element-wise function of the arrays in args, returning an array or a tuple of arrays
+    :param args: arrays or scalars, broadcast against each other
+    :param workers: number of threads. Defaults to the number of CPUs
+    :return: as function(*args)
+    """
+    arrays = np.broadcast_arrays(*[np.asarray(arg) for arg in args])
+    size = arrays[0].size if arrays else 0
+    workers = workers or os.cpu_count()
+    if size < min_size or workers < 2 or arrays[0].ndim != 1:
+        return function(*args)
+    starts = range(0, size, chunk_size)
+    first = function(*[arr[:chunk_size] for arr in arrays])
+    is_tuple = isinstance(first, tuple)
+    first = first if is_tuple else (first,)
+    outs = [np.empty(size, dtype=np.asarray(part).dtype) for part in first]
+    for out, part in zip(outs, first):
+        out[:chunk_size] = part
+
+    def evaluate(start):
+        result = function(*[arr[start:start + chunk_size] for arr in arrays])
+        for out, part in zip(outs, result if is_tuple else (result,)):
+            out[start:start + chunk_size] = part
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(evaluate, starts[1:]))
+    return tuple(outs) if is_tuple else outs[0]
+
+
+class ThermoContext:
+    """
+    Seawater thermodynamics of a glider dataset. Inputs are read from the dataset on every call, so results always
+    reflect its current temperature, salinity, pressure and position. Each gsw function is evaluated in chunks with
+    threaded_elementwise
+    """
+
+    def __init__(self, ds):
+        self.ds = ds
+
+    def practical_salinity(self, temperature=None):
+        """gsw.SP_from_C of conductivity (mS cm-1), temperature and pressure in the dataset. temperature overrides the
+        dataset temperature, e.g. with the effective temperature of the conductivity cell"""
+        ds = self.ds
+        if temperature is None:
+            temperature = ds["temperature"].values
+        return threaded_elementwise(gsw.SP_from_C, ds["conductivity"].values, temperature, ds["pressure"].values)
+
+    def absolute_salinity(self):
+        ds = self.ds
+        return threaded_elementwise(gsw.SA_from_SP, ds["salinity"].values, ds["pressure"].values,
+                                    ds["longitude"].values, ds["latitude"].values)
+
+    def conservative_temperature(self, absolute_salinity=None):
+        ds = self.ds
+        if absolute_salinity is None:
+            absolute_salinity = self.absolute_salinity()
+        return threaded_elementwise(gsw.CT_from_t, absolute_salinity, ds["temperature"].values, ds["pressure"].values)
+
+    def sigma0(self):
+        """Potential density anomaly referenced to 0 dbar, kg m-3 minus 1000"""
+        absolute_salinity = self.absolute_salinity()
+        return threaded_elementwise(gsw.density.sigma0, absolute_salinity,
+                                    self.conservative_temperature(absolute_salinity))
+
+    def density(self):
+        """In situ density from practical salinity, in situ temperature and pressure, as used for the density
+        variable"""
+        ds = self.ds
+        return threaded_elementwise(gsw.density.rho, ds["salinity"].values, ds["temperature"].values,
+                                    ds["pressure"].values)
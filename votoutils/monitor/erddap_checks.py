@@ -2,9 +2,10 @@ import httpx
 import numpy as np
 import datetime
 from erddapy import ERDDAP
-import geopandas as gp
 import pandas as pd
 from votoutils.utilities.utilities import mailer
+from votoutils.utilities.geocode import polygon_matches
+from votoutils.utilities.geometry_store import load_geometry_store
 import logging
 
 _log = logging.getLogger(__name__)
@@ -164,23 +165,12 @@ def international_waters_check(e, dataset_id):
                     'dive_num (None)': 'dive_num',
                     'vertical_distance_to_seafloor (m)': 'vertical_distance_to_seafloor'}, axis=1)
     df_glider = df[~np.isnan(df["vertical_distance_to_seafloor"])].groupby('dive_num').mean()
-    df_12nm = gp.read_file("/data/third_party/eez_12nm/eez_12nm_filled.geojson")
-    # extend the Swedish territorial waters by a buffer lenght
-    df_12nm_extend = df_12nm.copy()
-    df_12nm_extend = df_12nm_extend.to_crs('epsg:3152')
-    df_12nm_extend_in = df_12nm_extend.to_crs(epsg=4326)
-    # Create minimal dataset and group it by dives
-    df_glider = gp.GeoDataFrame(df_glider, geometry=gp.points_from_xy(df_glider.longitude, df_glider.latitude))
-    # Align crs and check which dives fall within Swedish 12 nm waters and helcom polygons
-    df_glider = df_glider.set_crs(epsg=4326)
-    df_12nm_extend = df_12nm_extend_in.to_crs(df_glider.crs)
-    df_12nm_extend = gp.sjoin(df_12nm_extend, df_glider, predicate='contains')
-    if df_12nm_extend.empty:
+    df_12nm_id = polygon_matches(load_geometry_store()["eez_12nm"], df_glider, "sovereign1")
+    if df_12nm_id.empty:
         return
     df_glider.index.rename("index", inplace=True)
     df_glider["dive_num"] = df_glider.index
-    df_12nm_extend_id = df_12nm_extend[["index_right", "sovereign1"]]
-    df_glider = pd.merge(df_glider, df_12nm_extend_id, left_on="dive_num", right_on="index_right", how="left")
+    df_glider = pd.merge(df_glider, df_12nm_id, left_on="dive_num", right_on="dive_num", how="left")
     df_glider.loc[df_glider.sovereign1 != "Sweden", "sovereign1"] = "International waters"
     if not (df_glider["sovereign1"].values == 'International waters').all():
         mailer("cherddap", f"potential territorial waters data in {dataset_id}")
@@ -0,0 +1,572 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import warnings
+import zipfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import logging
+
+_log = logging.getLogger(__name__)
+
+# IOOS QARTOD primary flags, as in ioos_qc.qartod.QartodFlags
+GOOD = 1
+UNKNOWN = 2
+SUSPECT = 3
+FAIL = 4
+MISSING = 9
+
+# ioos_qc.qartod.aggregate precedence, lowest to highest
+flag_priority = [MISSING, UNKNOWN, GOOD, SUSPECT, FAIL]
+_rank_of_flag = np.zeros(256, dtype=np.uint8)
+for _rank, _flag in enumerate(flag_priority):
+    _rank_of_flag[_flag] = _rank
+_flag_of_rank = np.array(flag_priority, dtype=np.uint8)
+
+QcTest = namedtuple("QcTest", "stream_id test kwargs")
+
+
+def _as_float(arr):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return np.asarray(arr, dtype=np.float64)
+
+
+def gross_range_flags(inp, fail_span, suspect_span=None):
+    """Vectorized equivalent of ioos_qc.qartod.gross_range_test"""
+    inp = _as_float(inp)
+    fail_min, fail_max = sorted(fail_span)
+    missing = ~np.isfinite(inp)
+    flags = np.ones(inp.shape, dtype=np.uint8)
+    # as in ioos_qc, infinite values are MISSING but may then be overwritten by the range checks
+    flags[missing] = MISSING
+    with np.errstate(invalid="ignore"):
+        if suspect_span is not None:
+            sus_min, sus_max = sorted(suspect_span)
+            if sus_min < fail_min or sus_max > fail_max:
+                raise ValueError(f"Suspect span {suspect_span} must fall within the fail span {fail_span}")
+            flags[(inp < sus_min) | (inp > sus_max)] = SUSPECT
+        flags[(inp < fail_min) | (inp > fail_max)] = FAIL
+    return flags
+
+
+def spike_diff(inp):
+    """
+    Spike test statistic: absolute difference between each sample and the mean of its neighbours
+    :return: the difference and a mask of where a neighbour is missing
+    """
+    ref = np.zeros(inp.shape, dtype=np.float64)
+    ref[1:-1] = (inp[:-2] + inp[2:]) / 2
+    ref_missing = ~np.isfinite(ref)
+    with np.errstate(invalid="ignore"):
+        diff = np.abs(inp - ref)
+    return diff, ref_missing
+
+
+def spike_flags(inp, suspect_threshold=None, fail_threshold=None, method="average"):
+    """Vectorized equivalent of ioos_qc.qartod.spike_test (average method)"""
+    if method != "average":
+        raise ValueError(f"spike method {method} not supported by batch QC")
+    inp = _as_float(inp)
+    missing = ~np.isfinite(inp)
+    flags = np.ones(inp.shape, dtype=np.uint8)
+    if inp.size == 0:
+        return flags
+    diff, ref_missing = spike_diff(inp)
+    with np.errstate(invalid="ignore"):
+        if suspect_threshold:
+            flags[diff > suspect_threshold] = SUSPECT
+        if fail_threshold:
+            flags[diff > fail_threshold] = FAIL
+    # test is undefined for first and last values, or where a neighbour is missing
+    flags[0] = UNKNOWN
+    flags[-1] = UNKNOWN
+    flags[ref_missing] = UNKNOWN
+    flags[missing] = MISSING
+    return flags
+
+
+def location_flags(lon, lat):
+    """Vectorized equivalent of ioos_qc.qartod.location_test without the optional range check"""
+    lon = _as_float(lon)
+    lat = _as_float(lat)
+    if lon.shape != lat.shape:
+        raise ValueError(f"Longitude ({lon.shape}) and latitude ({lat.shape}) are different sizes.")
+    lon_missing = ~np.isfinite(lon)
+    lat_missing = ~np.isfinite(lat)
+    flags = np.ones(lon.shape, dtype=np.uint8)
+    flags[lon_missing | lat_missing] = MISSING
+    flags[lon_missing != lat_missing] = FAIL
+    with np.errstate(invalid="ignore"):
+        flags[(np.abs(lat) > 90) | (np.abs(lon) > 180)] = FAIL
+    return flags
+
+
+# Per-test outcomes are packed 2 bits per test: 0 GOOD, 1 not evaluated (UNKNOWN or MISSING), 2 SUSPECT, 3 FAIL
+test_bits = 2
+max_packed_tests = 16 // test_bits
+_code_of_flag = np.zeros(256, dtype=np.uint16)
+_code_of_flag[[UNKNOWN, MISSING]] = 1
+_code_of_flag[SUSPECT] = 2
+_code_of_flag[FAIL] = 3
+_flag_of_code = np.array([GOOD, UNKNOWN, SUSPECT, FAIL], dtype=np.uint8)
+
+
+def aggregate_flags(flag_arrays, out=None):
+    """
+    Roll up per-test flags by QARTOD precedence, as ioos_qc.qartod.aggregate
+    :param flag_arrays: iterable of equal length flag arrays
+    :param out: optional array to write the aggregate flags into
+    :return: aggregate flags
+    """
+    flag_arrays = list(flag_arrays)
+    if not flag_arrays:
+        raise ValueError("No flags to aggregate")
+    rank = _rank_of_flag[flag_arrays[0]]
+    for flags in flag_arrays[1:]:
+        np.maximum(rank, _rank_of_flag[flags], out=rank)
+    if out is None:
+        return _flag_of_rank[rank]
+    out[:] = _flag_of_rank[rank]
+    return out
+
+
+# function: vectorized kernel. kwargs: config parameters it accepts. halo: samples of neighbouring data either side
+# that each flag depends on, None if unbounded. inputs: extra dataset variables passed to the kernel by name.
+# module: config section the test is configured in
+QcKernel = namedtuple("QcKernel", "function kwargs halo inputs module")
+qc_tests = {
+    "gross_range_test": QcKernel(gross_range_flags, ("fail_span", "suspect_span"), 0, (), "qartod"),
+    "spike_test": QcKernel(spike_flags, ("suspect_threshold", "fail_threshold", "method"), 1, (), "qartod"),
+    "location_test": QcKernel(location_flags, (), 0, (), "qartod"),
+}
+location_streams = ("longitude", "latitude")
+
+
+def register_qc_test(test_name, function, kwargs, halo=0, inputs=(), module="qartod"):
+    """Make a vectorized test kernel available to QC plans"""
+    qc_tests[test_name] = QcKernel(function, tuple(kwargs), halo, tuple(inputs), module)
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(val) for val in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in value.items()))
+    return value
+
+
+def compile_plan(configs, variables):
+    """
+    Compile a dict of ioos_qc configs into one deduplicated test plan.
+    Each (variable, test, parameters) combination appears once in plan["tests"], plan["rollups"] lists the tests
+    that are aggregated into each config's flags. Streams that are not in variables are skipped, as ioos_qc does.
+    Tests the batch engine cannot reproduce exactly raise a ValueError.
+    :param configs: dict of config name: ioos_qc config, as from flag_qartod.get_configs
+    :param variables: names of the variables available in the dataset
+    :return: plan dict
+    """
+    variables = set(variables)
+    tests = OrderedDict()
+    rollups = OrderedDict()
+    for config_name, config in configs.items():
+        keys = []
+        for stream_id, stream_config in config.items():
+            if stream_id not in variables:
+                _log.warning(f"{stream_id} is not a variable in the dataset, skipping")
+                continue
+            for module, module_tests in stream_config.items():
+                for test_name, kwargs in module_tests.items():
+                    if test_name not in qc_tests or qc_tests[test_name].module != module:
+                        raise ValueError(f"QC test {module}.{test_name} not supported by batch QC")
+                    missing_inputs = set(qc_tests[test_name].inputs) - variables
+                    if missing_inputs:
+                        _log.warning(f"{missing_inputs} needed by {test_name} not in the dataset, skipping")
+                        continue
+                    if test_name == "location_test":
+                        if kwargs.get("range_max") is not None:
+                            raise ValueError("location_test range_max not supported by batch QC")
+                        if not set(location_streams).issubset(variables):
+                            continue
+                        # ioos_qc tests the dataset position, whichever stream the test is configured for
+                        test_stream = None
+                    else:
+                        test_stream = stream_id
+                    accepted = qc_tests[test_name].kwargs
+                    test_kwargs = {key: _freeze(val) for key, val in kwargs.items() if key in accepted}
+                    key = (test_stream, test_name, _freeze(test_kwargs))
+                    if key not in tests:
+                        tests[key] = QcTest(test_stream, test_name, test_kwargs)
+                    if key not in keys:
+                        keys.append(key)
+        rollups[config_name] = keys
+    total_calls = sum(len(keys) for keys in rollups.values())
+    _log.info(f"compiled {total_calls} QC calls into {len(tests)} unique tests")
+    return {"tests": tests, "rollups": rollups}
+
+
+def plan_variables(plan):
+    """Names of the dataset variables that a plan reads"""
+    names = []
+    for qc_test in plan["tests"].values():
+        streams = location_streams if qc_test.stream_id is None else (qc_test.stream_id,)
+        for name in streams + qc_tests[qc_test.test].inputs:
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def plan_halo(plan):
+    """Number of neighbouring samples either side that any test in the plan depends on"""
+    halos = [qc_tests[qc_test.test].halo for qc_test in plan["tests"].values()]
+    if None in halos:
+        raise ValueError("QC plan has tests that depend on whole profiles and cannot be split into blocks")
+    return max(halos, default=0)
+
+
+def run_test(qc_test, data):
+    kernel = qc_tests[qc_test.test]
+    inputs = {name: data[name] for name in kernel.inputs}
+    if qc_test.stream_id is None:
+        return kernel.function(data["longitude"], data["latitude"], **inputs, **qc_test.kwargs)
+    return kernel.function(data[qc_test.stream_id], **inputs, **qc_test.kwargs)
+
+
+def run_plan(plan, data, keys=None):
+    """
+    Run every unique test in the plan once
+    :param plan: plan from compile_plan
+    :param data: mapping of variable name to 1D array
+    :param keys: optional subset of plan test keys to run
+    :return: dict of test key: uint8 flags
+    """
+    results = OrderedDict()
+    for key, qc_test in plan["tests"].items():
+        if keys is not None and key not in keys:
+            continue
+        try:
+            results[key] = run_test(qc_test, data)
+        except ValueError as err:
+            # ioos_qc logs and drops tests that fail to run, do the same
+            _log.error(f"Could not run {qc_test.test} on {qc_test.stream_id}: {err}")
+    return results
+
+
+def rollup_results(plan, results):
+    """Aggregate per-test results into the flags of every config in the plan"""
+    flags = OrderedDict()
+    for config_name, keys in plan["rollups"].items():
+        config_results = [results[key] for key in keys if key in results]
+        if not config_results:
+            continue
+        flags[config_name] = aggregate_flags(config_results)
+    return flags
+
+
+def test_labels(plan, config_name, results):
+    """Labels of the tests packed for config_name, in bit order. Location tests are labelled position"""
+    labels = []
+    for key in plan["rollups"][config_name]:
+        if key not in results:
+            continue
+        stream_id, test_name = key[0], key[1]
+        label = f"{stream_id or 'position'}_{test_name}"
+        suffix = 2
+        while label in labels:
+            label = f"{stream_id or 'position'}_{test_name}_{suffix}"
+            suffix += 1
+        labels.append(label)
+    return labels
+
+
+def pack_test_flags(plan, config_name, results, out=None):
+    """
+    Pack the outcome of every test in a config's rollup into a uint16 per sample, 2 bits per test in rollup order
+    :return: packed uint16 flags
+    """
+    keys = [key for key in plan["rollups"][config_name] if key in results]
+    if len(keys) > max_packed_tests:
+        raise ValueError(f"{config_name} has {len(keys)} tests, only {max_packed_tests} can be packed in 16 bits")
+    if out is None:
+        out = np.zeros(len(results[keys[0]]), dtype=np.uint16)
+    else:
+        out[:] = 0
+    for i, key in enumerate(keys):
+        out |= _code_of_flag[results[key]] << np.uint16(test_bits * i)
+    return out
+
+
+def unpack_test_flags(packed, position):
+    """QARTOD flags (GOOD, UNKNOWN, SUSPECT or FAIL) of the test at position from packed uint16 flags"""
+    codes = (np.asarray(packed).astype(np.uint16) >> np.uint16(test_bits * position)) & np.uint16(3)
+    return _flag_of_code[codes]
+
+
+def dataset_arrays(ds, names, start=None, stop=None):
+    if start is None and stop is None:
+        return {name: ds[name].values for name in names}
+    return {name: ds[name].isel(time=slice(start, stop)).values for name in names}
+
+
+def batch_flags(ds, configs, pack_tests=False):
+    """
+    Run all configs against ds in a single pass, running each unique test once
+    :param pack_tests: also return the outcome of each test, packed by pack_test_flags
+    :return: dict of config name: uint8 aggregate flags. If pack_tests, also a dict of config name:
+     (uint16 packed test flags, test labels)
+    """
+    variables = list(ds.variables) + list(ds.coords)
+    plan = compile_plan(configs, variables)
+    data = dataset_arrays(ds, plan_variables(plan))
+    results = run_plan(plan, data)
+    flags = rollup_results(plan, results)
+    if not pack_tests:
+        return flags
+    packed = OrderedDict()
+    for config_name in flags.keys():
+        packed[config_name] = (pack_test_flags(plan, config_name, results),
+                               test_labels(plan, config_name, results))
+    return flags, packed
+
+
+def chunked_batch_flags(ds, configs, chunk_size=2 ** 20, pack_tests=False):
+    """
+    Batch QC over ds in blocks of chunk_size samples, for datasets too large to QC in one pass.
+    Each block is read with a halo of neighbouring samples for window tests (e.g. spike) so the flags are identical
+    to batch_flags. Flags are written straight into preallocated int8 arrays, so peak memory scales with
+    chunk_size rather than mission length. Open ds lazily (without load) to also bound the memory used by the inputs.
+    :param pack_tests: also return packed per-test flags, as batch_flags
+    :return: dict of config name: int8 aggregate flags
+    """
+    variables = list(ds.variables) + list(ds.coords)
+    plan = compile_plan(configs, variables)
+    names = plan_variables(plan)
+    halo = plan_halo(plan)
+    length = ds.sizes["time"]
+    flags = OrderedDict()
+    packed = OrderedDict()
+    for start in range(0, length, chunk_size):
+        stop = min(start + chunk_size, length)
+        read_start = max(start - halo, 0)
+        read_stop = min(stop + halo, length)
+        data = dataset_arrays(ds, names, read_start, read_stop)
+        results = run_plan(plan, data)
+        trim = slice(start - read_start, stop - read_start)
+        results = OrderedDict((key, result[trim]) for key, result in results.items())
+        for config_name, keys in plan["rollups"].items():
+            config_results = [results[key] for key in keys if key in results]
+            if not config_results:
+                continue
+            if config_name not in flags:
+                flags[config_name] = np.empty(length, dtype=np.int8)
+            aggregate_flags(config_results, out=flags[config_name][start:stop])
+            if pack_tests:
+                if config_name not in packed:
+                    packed[config_name] = (np.empty(length, dtype=np.uint16),
+                                           test_labels(plan, config_name, results))
+                pack_test_flags(plan, config_name, results, out=packed[config_name][0][start:stop])
+        _log.debug(f"QC chunk {start}:{stop} of {length} complete")
+    if pack_tests:
+        return flags, packed
+    return flags
+
+
+def _attach_shared(spec):
+    shm = shared_memory.SharedMemory(name=spec[0])
+    return shm, np.ndarray(spec[1], dtype=spec[2], buffer=shm.buf)
+
+
+def _shared_test_worker(qc_test, input_specs, output_spec, row):
+    """Run one plan test on inputs in shared memory, writing flags into its row of the shared output"""
+    handles = []
+    try:
+        data = {}
+        for name, spec in input_specs.items():
+            shm, arr = _attach_shared(spec)
+            handles.append(shm)
+            data[name] = arr
+        shm, out = _attach_shared(output_spec)
+        handles.append(shm)
+        out[row] = run_test(qc_test, data)
+        return None
+    except ValueError as err:
+        return str(err)
+    finally:
+        data = out = None
+        for shm in handles:
+            shm.close()
+
+
+def _to_shared(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[:] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def parallel_batch_flags(ds, configs, workers=None):
+    """
+    Batch QC with the unique tests of the plan evaluated concurrently on a process pool.
+    Input arrays and the per-test results live in shared memory, so no data is pickled to or from the workers.
+    Results are aggregated in plan order, so the flags are identical to batch_flags.
+    :param workers: number of worker processes. Defaults to the number of CPUs
+    :return: dict of config name: uint8 aggregate flags
+    """
+    variables = list(ds.variables) + list(ds.coords)
+    plan = compile_plan(configs, variables)
+    data = dataset_arrays(ds, plan_variables(plan))
+    keys = list(plan["tests"].keys())
+    length = ds.sizes["time"]
+    segments = []
+    try:
+        input_specs = {}
+        for name, arr in data.items():
+            shm, spec = _to_shared(np.asarray(arr))
+            segments.append(shm)
+            input_specs[name] = spec
+        out_shm, output_spec = _to_shared(np.zeros((len(keys), length), dtype=np.uint8))
+        segments.append(out_shm)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_shared_test_worker, plan["tests"][key], input_specs, output_spec, row)
+                       for row, key in enumerate(keys)]
+            errors = [future.result() for future in futures]
+        out = np.ndarray(output_spec[1], dtype=output_spec[2], buffer=out_shm.buf)
+        results = OrderedDict()
+        for row, key in enumerate(keys):
+            if errors[row] is not None:
+                _log.error(f"Could not run qartod.{key[1]} on {key[0]}: {errors[row]}")
+                continue
+            results[key] = out[row]
+        flags = rollup_results(plan, results)
+        # aggregate_flags returns new arrays, release the shared output
+        results = out = None
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+    return flags
+
+
+def plan_signature(plan):
+    return repr((list(plan["tests"].keys()), list(plan["rollups"].items())))
+
+
+def block_fingerprints(data, names, block_size):
+    """blake2b hash of each block_size chunk of the named input arrays"""
+    length = len(data[names[0]])
+    hashes = []
+    for start in range(0, length, block_size):
+        digest = hashlib.blake2b(digest_size=16)
+        for name in names:
+            digest.update(np.ascontiguousarray(data[name][start:start + block_size]).tobytes())
+        hashes.append(digest.hexdigest())
+    return np.array(hashes, dtype="U32")
+
+
+def load_qc_cache(cache_path, config_names=()):
+    """
+    Flags and input fingerprints of the previous run. The cache is disposable, so an unreadable or incomplete file is
+    treated as absent
+    :param config_names: configs whose flags the cache must hold
+    :return: dict of array name: array, or None if there is no usable cache
+    """
+    cache_path = pathlib.Path(cache_path)
+    if not cache_path.exists():
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            cache = {name: cache[name] for name in cache.files}
+    except (OSError, ValueError, zipfile.BadZipFile) as err:
+        _log.warning(f"Could not read QC cache {cache_path}: {err}. Recomputing all flags")
+        return None
+    missing = {"signature", "block_size", "hashes"}.union(f"flags_{name}" for name in config_names) - set(cache)
+    if missing:
+        _log.warning(f"QC cache {cache_path} is missing {', '.join(sorted(missing))}. Recomputing all flags")
+        return None
+    return cache
+
+
+def save_qc_cache(cache_path, signature, block_size, hashes, flags):
+    cache_path = pathlib.Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    arrays = {"signature": np.array(signature), "block_size": np.array(block_size), "hashes": hashes}
+    for config_name, config_flags in flags.items():
+        arrays[f"flags_{config_name}"] = config_flags
+    # unique temporary name, so overlapping runs of the same mission do not write into one file
+    with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix=".npz", delete=False) as fout:
+        try:
+            np.savez(fout, **arrays)
+        except BaseException:
+            fout.close()
+            os.unlink(fout.name)
+            raise
+    os.replace(fout.name, cache_path)
+
+
+def first_changed_sample(cache, hashes, block_size):
+    """Start of the first block whose inputs differ from the cached run, or None if nothing changed"""
+    old_hashes = cache["hashes"]
+    common = min(len(old_hashes), len(hashes))
+    changed = np.flatnonzero(old_hashes[:common] != hashes[:common])
+    if len(changed):
+        return int(changed[0]) * block_size
+    if len(old_hashes) == len(hashes):
+        return None
+    # the last common block was partial in one of the runs
+    return max(common - 1, 0) * block_size
+
+
+def incremental_batch_flags(ds, configs, cache_path, block_size=2 ** 16):
+    """
+    Batch QC that only recomputes flags for samples that changed since the previous run.
+    Inputs are fingerprinted in blocks of block_size samples. Flags from the previous run are reused up to the first
+    changed block, less the halo of neighbouring samples that window tests (e.g. spike) depend on. The tests are run
+    on the remaining tail only, so the result is identical to a full recompute with batch_flags.
+    :param ds: glider timeseries dataset
+    :param configs: dict of ioos_qc configs
+    :param cache_path: npz file holding flags and input fingerprints from the previous run. Created if absent
+    :param block_size: number of samples per fingerprint block
+    :return: dict of config name: uint8 aggregate flags
+    """
+    variables = list(ds.variables) + list(ds.coords)
+    plan = compile_plan(configs, variables)
+    names = plan_variables(plan)
+    data = dataset_arrays(ds, names)
+    signature = plan_signature(plan)
+    length = ds.sizes["time"]
+    fingerprint_names = list(names)
+    if "time" in ds.variables:
+        data["time"] = ds["time"].values
+        fingerprint_names.append("time")
+    hashes = block_fingerprints(data, fingerprint_names, block_size)
+    cache = load_qc_cache(cache_path, plan["rollups"].keys())
+    if cache is None:
+        changed = 0
+    elif str(cache["signature"]) != signature or int(cache["block_size"]) != block_size:
+        _log.info("QC config changed since previous run. Recomputing all flags")
+        changed = 0
+    else:
+        changed = first_changed_sample(cache, hashes, block_size)
+        if changed is None:
+            changed = length
+    halo = plan_halo(plan)
+    keep = max(changed - halo, 0)
+    run_start = max(keep - halo, 0)
+    _log.info(f"Incremental QC: reusing flags for {keep} of {length} samples")
+    if keep < length:
+        tail_data = {name: arr[run_start:] for name, arr in data.items()}
+        tail_flags = rollup_results(plan, run_plan(plan, tail_data))
+    else:
+        tail_flags = {config_name: np.empty(0, dtype=np.uint8) for config_name in plan["rollups"]}
+    flags = OrderedDict()
+    for config_name, config_tail in tail_flags.items():
+        config_tail = config_tail[keep - run_start:]
+        if keep:
+            flags[config_name] = np.concatenate((cache[f"flags_{config_name}"][:keep], config_tail))
+        else:
+            flags[config_name] = config_tail
+    save_qc_cache(cache_path, signature, block_size, hashes, flags)
+    return flags
@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import logging
+import pathlib
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+from votoutils.qc.batch_qartod import batch_flags
+from votoutils.qc.flag_qartod import flag_ioos, flag_oxygen, flag_pilot, apply_flags, get_configs, derive_configs
+
+_log = logging.getLogger(__name__)
+
+default_sizes = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+results_columns = ["timestamp", "commit", "function", "config", "samples", "seconds", "peak_mb"]
+
+variable_attrs = {
+    "pressure": {"long_name": "water pressure", "standard_name": "sea_water_pressure", "units": "dbar"},
+    "depth": {"long_name": "glider depth", "standard_name": "depth", "units": "m"},
+    "temperature": {"long_name": "water temperature", "standard_name": "sea_water_temperature", "units": "Celsius"},
+    "salinity": {"long_name": "water salinity", "standard_name": "sea_water_practical_salinity", "units": "1"},
+    "conductivity": {"long_name": "water conductivity", "standard_name": "sea_water_electrical_conductivity",
+                     "units": "mS cm-1"},
+    "oxygen_concentration": {"long_name": "oxygen concentration",
+                             "standard_name": "mole_concentration_of_dissolved_molecular_oxygen_in_sea_water",
+                             "units": "mmol m-3"},
+    "chlorophyll": {"long_name": "chlorophyll", "standard_name": "concentration_of_chlorophyll_in_sea_water",
+                    "units": "mg m-3"},
+    "longitude": {"long_name": "longitude", "standard_name": "longitude", "units": "degrees_east"},
+    "latitude": {"long_name": "latitude", "standard_name": "latitude", "units": "degrees_north"},
+    "potential_density": {"long_name": "water potential density", "standard_name": "sea_water_potential_density",
+                          "units": "kg m-3"},
+    "density": {"long_name": "water density", "standard_name": "sea_water_density", "units": "kg m-3"},
+    "potential_temperature": {"long_name": "water potential temperature",
+                              "standard_name": "sea_water_potential_temperature", "units": "Celsius"},
+}
+
+
+def synthetic_glider(num_samples, seed=0, samples_per_dive=600):
+    """
+    Synthetic glider timeseries with the variables and attributes flag_ioos, flag_oxygen and flag_pilot expect.
+    Dives are a sawtooth in depth through a two-layer Baltic water column, sampled about once per second, with
+    sensor dropouts, spikes, out of range values and a sparsely sampled oxygen optode
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.uniform(0.5, 1.5, num_samples).cumsum()
+    time_s = np.datetime64("2024-03-01T00:00:00") + (steps * 1e3).astype("timedelta64[ms]")
+    dive_num = np.arange(num_samples) // samples_per_dive + 1
+    phase = (np.arange(num_samples) % samples_per_dive) / samples_per_dive
+    max_depth = rng.uniform(60, 120, dive_num[-1] + 1)[dive_num]
+    depth = max_depth * (1 - np.abs(2 * phase - 1)) + rng.normal(0, 0.05, num_samples)
+    halocline = 1 / (1 + np.exp(-(depth - 60) / 5))
+    data = {
+        "pressure": depth * 1.01,
+        "depth": depth,
+        "temperature": 12 - 8 * (1 - np.exp(-depth / 20)) + 2 * halocline + rng.normal(0, 0.05, num_samples),
+        "salinity": 7.5 + 8 * halocline + rng.normal(0, 0.02, num_samples),
+        "oxygen_concentration": 350 - 300 * halocline + rng.normal(0, 2, num_samples),
+        "chlorophyll": np.abs(2 * np.exp(-depth / 15) + rng.normal(0, 0.1, num_samples)),
+        "longitude": 18.5 + np.cumsum(rng.normal(0, 2e-6, num_samples)),
+        "latitude": 57.5 + np.cumsum(rng.normal(0, 2e-6, num_samples)),
+    }
+    data["conductivity"] = 0.9 * data["salinity"] + 0.4 * data["temperature"] + 3
+    data["potential_temperature"] = data["temperature"] - 1e-4 * depth
+    data["density"] = 1000 + 0.78 * data["salinity"] - 0.05 * data["temperature"] + 0.0045 * depth
+    data["potential_density"] = data["density"] - 0.0045 * depth
+    # the optode samples every 10th CTD sample
+    data["oxygen_concentration"][np.arange(num_samples) % 10 != 0] = np.nan
+    for name, values in data.items():
+        dropouts = rng.choice(num_samples, num_samples // 100, replace=False)
+        values[dropouts] = np.nan
+        spikes = rng.choice(num_samples, num_samples // 1000, replace=False)
+        values[spikes] += rng.normal(0, 10 * np.nanstd(values[:10000]) + 1e-3, len(spikes))
+        values[rng.choice(num_samples, max(num_samples // 10000, 1), replace=False)] = 1e4
+    ds = xr.Dataset(coords={"time": ("time", time_s, {"long_name": "time", "standard_name": "time"})})
+    for name, values in data.items():
+        ds[name] = ("time", values, {**variable_attrs[name], "observation_type": "measured", "comment": ""})
+    ds["dive_num"] = ("time", dive_num.astype(np.float64), {"long_name": "dive number", "units": "1"})
+    ds.attrs = {
+        "glider_serial": "999",
+        "deployment_id": "1",
+        "basin": "Eastern Gotland",
+        "oxygen": str({"make_model": "RBR legato3 coda", "calibration_date": "2022-06-01",
+                       "serial_number": "1234"}),
+    }
+    return ds
+
+
+def synthetic_mission_yaml(ds, yaml_path):
+    """Mission yaml with pilot QC entries over the span of ds: single and multiple intervals, open ended intervals
+    and a derived variable"""
+    start, end = ds.time.values[0], ds.time.values[-1]
+    span = end - start
+
+    def at(fraction):
+        return str((start + span * fraction).astype("datetime64[s]"))
+
+    deployment = {
+        "glider_serial": ds.attrs["glider_serial"],
+        "deployment_id": ds.attrs["deployment_id"],
+        "qc": {
+            "temperature": [
+                {"start": at(0.1), "end": at(0.2), "value": 3, "comment": "CTD pump stalled"},
+                {"start": at(0.6), "end": at(0.65), "value": 4, "comment": "CTD fouled"},
+            ],
+            "oxygen_concentration": {"start": at(0.5), "value": 3, "comment": "optode drift"},
+            "chlorophyll": {"end": at(0.05), "value": 3, "comment": "biofouling wiper stuck"},
+        },
+    }
+    with open(yaml_path, "w") as fout:
+        yaml.safe_dump(deployment, fout)
+    return yaml_path
+
+
+def measure(function, prepare, repeats):
+    """
+    Best runtime of repeats untraced calls and peak traced memory of one extra call. prepare is called before each
+    call, outside the timer, and returns the arguments of the call
+    """
+    times = []
+    for i in range(repeats):
+        args = prepare()
+        tic = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - tic)
+        del args
+    args = prepare()
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def benchmark_size(num_samples, repeats=3, per_config=True, seed=0):
+    """Runtime and peak memory of the QC functions on one synthetic dataset"""
+    _log.info(f"benchmarking {num_samples} samples")
+    ds = synthetic_glider(num_samples, seed=seed)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mission_yaml = synthetic_mission_yaml(ds, pathlib.Path(tmp_dir) / "SEA999_M1.yml")
+        ds_flagged = flag_ioos(ds.copy())
+        benchmarks = {
+            "flag_ioos": (flag_ioos, lambda: (ds.copy(),)),
+            "flag_oxygen": (flag_oxygen, lambda: (ds_flagged.copy(deep=True),)),
+            "flag_pilot": (flag_pilot, lambda: (ds_flagged.copy(deep=True), mission_yaml)),
+            "apply_flags": (apply_flags, lambda: (ds_flagged.copy(deep=True),)),
+        }
+        for function_name, (function, prepare) in benchmarks.items():
+            seconds, peak_mb = measure(function, prepare, repeats)
+            rows.append([function_name, "all", num_samples, seconds, peak_mb])
+        if per_config:
+            # batch_flags with a single config runs exactly that config's tests, whereas flag_ioos also runs the
+            # configs of any other variable in the dataset
+            for config_name, config in derive_configs(get_configs()).items():
+                seconds, peak_mb = measure(batch_flags, lambda: (ds, {config_name: config}), repeats)
+                rows.append(["batch_flags", config_name, num_samples, seconds, peak_mb])
+    for row in rows:
+        _log.info(f"{row[0]} {row[1]} {row[2]} samples: {row[3]:.3f} s, peak {row[4]:.1f} MB")
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=pathlib.Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(sizes=None, repeats=3, per_config=True, results_csv="qc_benchmark.csv"):
+    """
+    Benchmark the QC functions over a range of dataset sizes and append the results to results_csv, tagged with the
+    current git commit so runs from different commits can be compared with compare_benchmarks
+    """
+    sizes = sizes or default_sizes
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    commit = git_commit()
+    rows = []
+    for num_samples in sizes:
+        rows += [[timestamp, commit] + row for row in benchmark_size(num_samples, repeats, per_config)]
+    df = pd.DataFrame(rows, columns=results_columns)
+    results_csv = pathlib.Path(results_csv)
+    if results_csv.exists():
+        df = pd.concat((pd.read_csv(results_csv), df))
+    df.to_csv(results_csv, index=False)
+    _log.info(f"wrote {len(rows)} benchmark results to {results_csv}")
+    return df
+
+
+def compare_benchmarks(results_csv="qc_benchmark.csv", baseline=None, commit=None):
+    """
+    Compare the latest results of two commits, by default the two most recent in results_csv
+    :return: DataFrame of runtime and memory ratios, commit / baseline, so values above 1 are regressions
+    """
+    df = pd.read_csv(results_csv, dtype={"commit": str})
+    commits = list(df.sort_values("timestamp").commit.drop_duplicates(keep="last"))
+    commit = commit or commits[-1]
+    if not baseline:
+        if len(commits) < 2:
+            raise ValueError(f"need results from two commits in {results_csv} to compare")
+        baseline = [previous for previous in commits if previous != commit][-1]
+    keys = ["function", "config", "samples"]
+    latest = df.sort_values("timestamp").drop_duplicates(keys + ["commit"], keep="last")
+    df_new = latest[latest.commit == commit].set_index(keys)
+    df_base = latest[latest.commit == baseline].set_index(keys)
+    df_compare = df_new[["seconds", "peak_mb"]].join(df_base[["seconds", "peak_mb"]], rsuffix="_baseline",
+                                                     how="inner")
+    df_compare["time_ratio"] = df_compare.seconds / df_compare.seconds_baseline
+    df_compare["memory_ratio"] = df_compare.peak_mb / df_compare.peak_mb_baseline
+    _log.info(f"compared {commit} with baseline {baseline}")
+    return df_compare.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark runtime and peak memory of the QC functions on synthetic'
+                                                 ' glider data. 10^8 samples needs ~40 GB of RAM')
+    parser.add_argument('--sizes', type=int, nargs='+', help='number of samples, default 10^4 to 10^7')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per benchmark, best is kept')
+    parser.add_argument('--no-configs', action='store_true', help='skip the per config batch_flags benchmarks')
+    parser.add_argument('--results', type=str, default='qc_benchmark.csv', help='csv to append results to')
+    parser.add_argument('--compare', action='store_true', help='compare the two most recent commits in results')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    if args.compare:
+        print(compare_benchmarks(args.results).to_string())
+    else:
+        run_benchmarks(args.sizes, args.repeats, not args.no_configs, args.results)
@@ -0,0 +1,199 @@
+import pathlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging
+from votoutils.qc.batch_qartod import GOOD, UNKNOWN, SUSPECT, MISSING, _as_float, aggregate_flags
+from votoutils.utilities.geocode import dive_basins
+
+_log = logging.getLogger(__name__)
+
+climatology_grid_path = "/data/qc/climatology_grid.npz"
+default_depth_edges = np.array([0, 5, 10, 15, 20, 30, 40, 50, 60, 70, 80, 90, 100, 125, 150, 175, 200, 250, 300,
+                                400, 500, 750, 1000, 2000], dtype=np.float64)
+# Histogram bins used to estimate percentiles when building the grid
+default_value_bins = {
+    "temperature": np.arange(-2.5, 35.001, 0.05),
+    "salinity": np.arange(0, 42.001, 0.02),
+    "oxygen_concentration": np.arange(0, 600.001, 1),
+}
+# Added either side of the archive percentiles to give the allowed range
+default_margins = {
+    "temperature": 1.0,
+    "salinity": 0.5,
+    "oxygen_concentration": 20,
+}
+
+
+def month_index(time):
+    """Month of each sample, 0 for January"""
+    return np.asarray(time).astype("datetime64[M]").astype(np.int64) % 12
+
+
+def depth_bin_index(depth, depth_edges):
+    """Depth bin of each sample, -1 if outside the bins or missing"""
+    depth = _as_float(depth)
+    depth_bin = np.searchsorted(depth_edges, depth, side="right") - 1
+    depth_bin[~np.isfinite(depth) | (depth_bin >= len(depth_edges) - 1)] = -1
+    return depth_bin
+
+
+def sample_basin_codes(ds, basins):
+    """Index in basins of the HELCOM basin of each sample's dive, -1 if the dive is not in one of basins"""
+    dive_basin = dive_basins(ds)
+    basin_code = pd.Index(basins).get_indexer(dive_basin.values)
+    dive_code = pd.Index(dive_basin.index).get_indexer(ds["dive_num"].values)
+    codes = np.full(len(dive_code), -1, dtype=np.int64)
+    in_dive = dive_code >= 0
+    codes[in_dive] = basin_code[dive_code[in_dive]]
+    return codes
+
+
+def load_climatology_grid(grid_path=climatology_grid_path):
+    with np.load(grid_path, allow_pickle=False) as grid:
+        return {name: grid[name] for name in grid.files}
+
+
+def save_climatology_grid(grid, grid_path=climatology_grid_path):
+    grid_path = pathlib.Path(grid_path)
+    grid_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(grid_path, "wb") as fout:
+        np.savez_compressed(fout, **grid)
+
+
+def climatology_flags(inp, cell, ranges):
+    """
+    Flag samples outside the climatological range of their (basin, month, depth bin) cell as SUSPECT
+    :param inp: data
+    :param cell: flat index of each sample's cell in ranges, -1 if it has none
+    :param ranges: n_cells x 2 array of allowed min and max. NaN where the archive has too little data
+    :return: uint8 flags. UNKNOWN where there is no climatology for the sample
+    """
+    inp = _as_float(inp)
+    flags = np.full(inp.shape, UNKNOWN, dtype=np.uint8)
+    has_cell = cell >= 0
+    low = np.full(inp.shape, np.nan)
+    high = np.full(inp.shape, np.nan)
+    low[has_cell] = ranges[cell[has_cell], 0]
+    high[has_cell] = ranges[cell[has_cell], 1]
+    with np.errstate(invalid="ignore"):
+        flags[(inp >= low) & (inp <= high)] = GOOD
+        flags[(inp < low) | (inp > high)] = SUSPECT
+    flags[~np.isfinite(inp)] = MISSING
+    return flags
+
+
+def grid_cells(ds, grid):
+    """Flat index of each sample into the packed (basin, month, depth bin) axes of the grid"""
+    num_depths = len(grid["depth_edges"]) - 1
+    basin_code = sample_basin_codes(ds, list(grid["basins"]))
+    month = month_index(ds["time"].values)
+    depth_bin = depth_bin_index(ds["depth"].values, grid["depth_edges"])
+    cell = (basin_code * 12 + month) * num_depths + depth_bin
+    cell[(basin_code < 0) | (depth_bin < 0)] = -1
+    return cell
+
+
+def flag_climatology(ds, grid_path=climatology_grid_path):
+    """
+    Climatology range test by HELCOM basin, month and depth. Flags are merged into the existing *_qc variables by
+    QARTOD precedence. The lookup grid is built from the archive with build_climatology_grid
+    """
+    if not pathlib.Path(grid_path).exists():
+        _log.info(f"No climatology grid found at {grid_path}. Skipping climatology QC")
+        return ds
+    grid = load_climatology_grid(grid_path)
+    variables = [var for var in grid["variables"] if f"{var}_qc" in list(ds)]
+    if not variables:
+        return ds
+    cell = grid_cells(ds, grid)
+    for var in variables:
+        var_index = list(grid["variables"]).index(var)
+        flags = climatology_flags(ds[var].values, cell, grid["ranges"][var_index].reshape(-1, 2))
+        flagged_prop = 100 * np.sum(flags == SUSPECT) / len(flags)
+        _log.info(f"Climatology QC flagged {flagged_prop.round(3)} % of {var} as suspect")
+        var_qc = ds[f"{var}_qc"]
+        var_qc.values = aggregate_flags([var_qc.values.astype(np.uint8), flags]).astype(var_qc.dtype)
+        var_qc.attrs["comment"] = f"{var_qc.attrs['comment']} Climatology range test by HELCOM basin, month and " \
+                                  f"depth. Samples outside the range are SUSPECT."
+    return ds
+
+
+def accumulate_histograms(ds, histograms, value_bins, depth_edges):
+    """Add the good data of one mission to per basin histograms of shape (month, depth bin, value bin)"""
+    num_depths = len(depth_edges) - 1
+    dive_basin = dive_basins(ds)
+    basins = list(dive_basin.dropna().unique())
+    basin_code = sample_basin_codes(ds, basins)
+    month = month_index(ds["time"].values)
+    depth_bin = depth_bin_index(ds["depth"].values, depth_edges)
+    for var, bins in value_bins.items():
+        if var not in list(ds):
+            continue
+        values = _as_float(ds[var].values)
+        good = np.isfinite(values) & (basin_code >= 0) & (depth_bin >= 0)
+        if f"{var}_qc" in list(ds):
+            good &= ds[f"{var}_qc"].values <= 2
+        num_values = len(bins) - 1
+        value_bin = np.clip(np.searchsorted(bins, values[good], side="right") - 1, 0, num_values - 1)
+        cell = (month[good] * num_depths + depth_bin[good]) * num_values + value_bin
+        codes = basin_code[good]
+        for code, basin in enumerate(basins):
+            counts = np.bincount(cell[codes == code], minlength=12 * num_depths * num_values)
+            if basin not in histograms[var]:
+                histograms[var][basin] = np.zeros((12, num_depths, num_values), dtype=np.int64)
+            histograms[var][basin] += counts.reshape(12, num_depths, num_values)
+    return histograms
+
+
+def histogram_percentile_edges(hist, bins, percentile, upper):
+    """Value bin edge at a percentile of each histogram along the last axis"""
+    cumulative = np.cumsum(hist, axis=-1)
+    target = cumulative[..., -1:] * percentile / 100
+    index = np.argmax(cumulative >= target, axis=-1)
+    return bins[index + 1] if upper else bins[index]
+
+
+def build_climatology_grid(nc_files, grid_path=climatology_grid_path, value_bins=None, depth_edges=None,
+                           percentiles=(0.5, 99.5), margins=None, min_samples=100):
+    """
+    Build the climatology lookup grid from an archive of processed timeseries.
+    Good data (*_qc <= 2) are accumulated into histograms per basin, month and depth bin, so the archive is read
+    once. The allowed range of each cell is the percentiles of its histogram widened by a margin. Cells with fewer
+    than min_samples are left as NaN and give UNKNOWN flags.
+    :param nc_files: timeseries netCDFs with time, depth, dive_num, longitude, latitude and the QC variables
+    :return: the grid, also saved to grid_path
+    """
+    value_bins = value_bins or default_value_bins
+    margins = margins or default_margins
+    depth_edges = default_depth_edges if depth_edges is None else np.asarray(depth_edges, dtype=np.float64)
+    histograms = {var: {} for var in value_bins}
+    for nc_file in nc_files:
+        _log.info(f"adding {nc_file} to climatology")
+        keep = ["time", "depth", "dive_num", "longitude", "latitude"]
+        with xr.open_dataset(nc_file) as ds:
+            keep += [var for var in ds.variables for name in value_bins if var in (name, f"{name}_qc")]
+            ds = ds[[var for var in keep if var in ds.variables]].load()
+        accumulate_histograms(ds, histograms, value_bins, depth_edges)
+    variables = list(value_bins.keys())
+    basins = sorted({basin for var_hists in histograms.values() for basin in var_hists})
+    num_depths = len(depth_edges) - 1
+    ranges = np.full((len(variables), len(basins), 12, num_depths, 2), np.nan, dtype=np.float32)
+    counts = np.zeros((len(variables), len(basins), 12, num_depths), dtype=np.int64)
+    for var_index, var in enumerate(variables):
+        for basin_index, basin in enumerate(basins):
+            if basin not in histograms[var]:
+                continue
+            hist = histograms[var][basin]
+            total = hist.sum(axis=-1)
+            low = histogram_percentile_edges(hist, value_bins[var], percentiles[0], upper=False) - margins[var]
+            high = histogram_percentile_edges(hist, value_bins[var], percentiles[1], upper=True) + margins[var]
+            enough = total >= min_samples
+            ranges[var_index, basin_index, ..., 0] = np.where(enough, low, np.nan)
+            ranges[var_index, basin_index, ..., 1] = np.where(enough, high, np.nan)
+            counts[var_index, basin_index] = total
+    grid = {"variables": np.array(variables), "basins": np.array(basins), "depth_edges": depth_edges,
+            "ranges": ranges, "counts": counts, "percentiles": np.array(percentiles)}
+    save_climatology_grid(grid, grid_path)
+    _log.info(f"saved climatology grid for {len(basins)} basins to {grid_path}")
+    return grid
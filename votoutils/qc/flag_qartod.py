@@ -6,6 +6,9 @@ from ioos_qc.config import Config
 from ioos_qc.qartod import aggregate
 from ioos_qc.streams import XarrayStream
 from ioos_qc.results import collect_results, CollectedResult
+from votoutils.qc.batch_qartod import batch_flags, incremental_batch_flags, chunked_batch_flags, \
+    parallel_batch_flags, test_bits, unpack_test_flags
+from votoutils.qc.climatology import flag_climatology
 import datetime
 import logging
 
@@ -143,20 +146,71 @@ def apply_ioos_flags(ds, config):
     return flag_vals, proc_record
 
 
-def flag_ioos(ds):
+def flag_ioos(ds, engine="batch", qc_cache=None, chunk_size=None, workers=None, store_tests=False):
+    """
+    Apply IOOS QARTOD flags to the variables in get_configs
+    :param ds: glider timeseries dataset
+    :param engine: "batch" runs each unique test once over all configs, "ioos_qc" runs ioos_qc once per config
+    :param qc_cache: optional path to a cache file of flags from the previous run. With the batch engine, only
+     samples that changed since that run are recomputed
+    :param chunk_size: optional number of samples per block. With the batch engine, QC the dataset in blocks of this
+     size to bound peak memory
+    :param workers: optional number of processes. With the batch engine, run the QC tests concurrently on a process
+     pool
+    :param store_tests: with the batch engine, also store the outcome of each individual test in *_qc_tests variables,
+     packed 2 bits per test in a uint16. Decode them with decode_qc_tests
+    :return: ds with *_qc variables
+    """
+    if engine not in ["batch", "ioos_qc"]:
+        raise ValueError("engine must be batch or ioos_qc")
+    if sum(bool(option) for option in (qc_cache, chunk_size, workers)) > 1:
+        raise ValueError("only one of qc_cache, chunk_size and workers can be set")
+    if store_tests and (qc_cache or workers):
+        raise ValueError("store_tests cannot be combined with qc_cache or workers")
     configs = get_configs()
     # If the glider has a GPCTD, use this for the salinity config
     if ds["conductivity"].attrs["units"] == 'S m-1':
         configs["salinity"]["conductivity"]["qartod"]["gross_range_test"] = {"suspect_span": [0.6, 4.2],
                                                                              "fail_span": [0.3, 4.5]}
     configs = derive_configs(configs)
+    ds_variables = list(ds.variables) + list(ds.coords)
+    run_configs = {}
     for config_name, config in configs.items():
-        if config_name not in list(ds.variables) + list(ds.coords):
+        if config_name not in ds_variables:
             _log.warning(f"{config_name} not found in dataset")
             continue
+        if not set(config.keys()).issubset(set(ds_variables)):
+            _log.warning(f"{list(config.keys())} not found in dataset. Skipping")
+            continue
+        run_configs[config_name] = config
+    packed_results = {}
+    if engine == "batch":
+        try:
+            if store_tests and chunk_size:
+                batch_results, packed_results = chunked_batch_flags(ds, run_configs, chunk_size, pack_tests=True)
+            elif store_tests:
+                batch_results, packed_results = batch_flags(ds, run_configs, pack_tests=True)
+            elif qc_cache:
+                batch_results = incremental_batch_flags(ds, run_configs, qc_cache)
+            elif chunk_size:
+                batch_results = chunked_batch_flags(ds, run_configs, chunk_size)
+            elif workers:
+                batch_results = parallel_batch_flags(ds, run_configs, workers)
+            else:
+                batch_results = batch_flags(ds, run_configs)
+        except ValueError as err:
+            _log.warning(f"Batch QC not possible: {err}. Falling back to ioos_qc")
+            engine = "ioos_qc"
+    if store_tests and engine != "batch":
+        _log.warning("Per-test flags are only stored by the batch engine")
+    for config_name, config in run_configs.items():
         # extract ioos flags for these variables
-        flags, comment = apply_ioos_flags(ds, config)
-        flagged_prop = 100 * sum(np.logical_and(flags > 1, flags < 9)) / len(flags)
+        if engine == "batch":
+            flags = batch_results[config_name]
+            comment = str(Config(config).calls)
+        else:
+            flags, comment = apply_ioos_flags(ds, config)
+        flagged_prop = 100 * np.sum(np.logical_and(flags > 1, flags < 9)) / len(flags)
         _log.info(f"Flagged {flagged_prop.round(3)} % of {config_name} as bad")
         # Apply flags and add comment
         ioos_comment = f"Quality control flags from IOOS QC QARTOD https://github.com/ioos/ioos_qc Version: " \
@@ -166,8 +220,7 @@ def flag_ioos(ds):
                            f" Recommendations for in-situ data Near Real Time Quality Control [Version 1.2]. EuroGOOS" \
                            f", 23pp. DOI http://dx.doi.org/10.25607/OBP-214."
 
-        flag = ds[config_name].copy()
-        flag.values = flags
+        flag = ds[config_name].copy(data=flags)
         parent_attrs = flag.attrs
         flag.attrs = {
             'ioos_qc_module': 'qartod',
@@ -181,9 +234,62 @@ def flag_ioos(ds):
             "standard_name": f"{parent_attrs['standard_name']}_flag",
             "comment": ioos_comment}
         ds[f"{config_name}_qc"] = flag
+        if config_name in packed_results:
+            packed, labels = packed_results[config_name]
+            packed_flag = ds[config_name].copy(data=packed)
+            packed_flag.encoding = {}
+            packed_flag.attrs = test_flag_attrs(labels, parent_attrs)
+            ds[f"{config_name}_qc_tests"] = packed_flag
     return ds
 
 
+def test_flag_attrs(labels, parent_attrs):
+    flag_masks, flag_values, flag_meanings = [], [], []
+    for i, label in enumerate(labels):
+        mask = 3 << (test_bits * i)
+        for code, outcome in enumerate(["good", "not_evaluated", "suspect", "fail"]):
+            flag_masks.append(mask)
+            flag_values.append(code << (test_bits * i))
+            flag_meanings.append(f"{label}_{outcome}")
+    return {
+        "ioos_qc_module": "qartod",
+        "quality_control_conventions": "IOOS QARTOD standard flags",
+        "long_name": f"per-test quality control flags for {parent_attrs['long_name']}",
+        "flag_masks": np.array(flag_masks, dtype=np.uint16),
+        "flag_values": np.array(flag_values, dtype=np.uint16),
+        "flag_meanings": " ".join(flag_meanings),
+        "qc_tests": " ".join(labels),
+        "comment": f"Outcome of each QARTOD test that makes up the {parent_attrs['long_name']} quality control flag."
+                   f" Each test takes {test_bits} bits, in the order of qc_tests starting from the least significant"
+                   f" bits. 0 GOOD, 1 not evaluated (UNKNOWN or MISSING), 2 SUSPECT, 3 FAIL."}
+
+
+def decode_qc_tests(ds, variable):
+    """
+    Unpack the per-test flags stored by flag_ioos(store_tests=True)
+    :return: dict of test label: QARTOD flags (GOOD, UNKNOWN, SUSPECT or FAIL) for each sample
+    """
+    packed = ds[f"{variable}_qc_tests"]
+    labels = packed.attrs["qc_tests"].split()
+    return {label: unpack_test_flags(packed.values, i) for i, label in enumerate(labels)}
+
+
+def failed_only(ds, variable, test_label, min_flag=3):
+    """
+    Find samples flagged by one test and no other, e.g. samples that failed only the spike test
+    :param test_label: label of the test, as in the qc_tests attribute of the *_qc_tests variable
+    :param min_flag: flag at or above which a test counts as failed. 3 (SUSPECT) or 4 (FAIL)
+    :return: boolean array
+    """
+    test_flags = decode_qc_tests(ds, variable)
+    if test_label not in test_flags:
+        raise ValueError(f"{test_label} not stored for {variable}. Tests are {list(test_flags.keys())}")
+    only = test_flags.pop(test_label) >= min_flag
+    for flags in test_flags.values():
+        only &= flags < min_flag
+    return only
+
+
 def flag_oxygen(ds):
     oxy_meta_str = ds.oxygen
     import ast
@@ -204,11 +310,42 @@ def flag_oxygen(ds):
     return ds
 
 
-def flag_pilot(ds):
-    attrs = ds.attrs
-    glider = attrs["glider_serial"]
-    mission = attrs["deployment_id"]
-    mission_yaml = f"/data/deployment_yaml/mission_yaml/SEA{glider}_M{mission}.yml"
+def pilot_qc_intervals(pilot_qc):
+    """A variable's pilot QC entry can be a single interval or a list of intervals"""
+    if isinstance(pilot_qc, dict):
+        return [pilot_qc]
+    return list(pilot_qc)
+
+
+def time_is_sorted(time):
+    if np.isnat(time).any():
+        return False
+    return not np.any(time[1:] < time[:-1])
+
+
+def interval_index(time, time_sorted, start, end):
+    """
+    Index of the samples with start <= time <= end. A slice found by binary search if time is sorted, otherwise a
+    boolean mask. start and end of None are unbounded
+    """
+    if time_sorted:
+        first = 0 if start is None else np.searchsorted(time, start, side="left")
+        last = len(time) if end is None else np.searchsorted(time, end, side="right")
+        return slice(first, last)
+    in_interval = ~np.isnat(time)
+    if start is not None:
+        in_interval &= time >= start
+    if end is not None:
+        in_interval &= time <= end
+    return in_interval
+
+
+def flag_pilot(ds, mission_yaml=None):
+    if not mission_yaml:
+        attrs = ds.attrs
+        glider = attrs["glider_serial"]
+        mission = attrs["deployment_id"]
+        mission_yaml = f"/data/deployment_yaml/mission_yaml/SEA{glider}_M{mission}.yml"
     with open(mission_yaml) as fin:
         deployment = yaml.safe_load(fin)
     if "qc" not in deployment.keys():
@@ -220,6 +357,10 @@ def flag_pilot(ds):
     elif "conductivity" in deployment["qc"]:
         for ct_var in cond_temp_vars:
             deployment["qc"][ct_var] = deployment["qc"]["conductivity"]
+    time = ds.time.values
+    time_sorted = time_is_sorted(time)
+    # Resolve each interval once. Derived variables share the intervals of their parent entry
+    interval_indices = {}
     for variable in deployment["qc"]:
         if f"{variable}_qc" not in list(ds):
             _log.warning(f"{variable} in yaml qc section, but has no qc from IOOS. Applying minimum qc")
@@ -237,34 +378,42 @@ def flag_pilot(ds):
                 "standard_name": f"{parent_attrs['standard_name']}_flag",
                 "comment": "no automated QC applied"}
             ds[f"{variable}_qc"] = flag
-        pilot_qc = deployment["qc"][variable]
         var_qc = ds[f"{variable}_qc"]
-        time_str = ""
-        if "start" in pilot_qc.keys():
-            start_str = pilot_qc["start"]
-            start = np.datetime64(start_str)
-            time_str = f"start: {start_str}"
-        else:
-            start = np.nanmin(ds.time)
-        if "end" in pilot_qc.keys():
-            end_str = pilot_qc["end"]
-            end = np.datetime64(end_str)
-            time_str = f"{time_str}, end: {end_str}"
-        else:
-            end = np.nanmax(ds.time)
-        var_qc_timesub = var_qc.values[np.logical_and(ds.time >= start, ds.time <= end)]
-        var_qc_timesub[var_qc_timesub < pilot_qc['value']] = pilot_qc['value']
-        var_qc.values[np.logical_and(ds.time >= start, ds.time <= end)] = var_qc_timesub
+        flags = var_qc.values
+        pilot_comments = []
+        for pilot_qc in pilot_qc_intervals(deployment["qc"][variable]):
+            time_str = ""
+            start, end = None, None
+            if "start" in pilot_qc.keys():
+                start_str = pilot_qc["start"]
+                start = np.datetime64(start_str)
+                time_str = f"start: {start_str}"
+            if "end" in pilot_qc.keys():
+                end_str = pilot_qc["end"]
+                end = np.datetime64(end_str)
+                time_str = f"{time_str}, end: {end_str}"
+            if id(pilot_qc) not in interval_indices:
+                interval_indices[id(pilot_qc)] = interval_index(time, time_sorted, start, end)
+            index = interval_indices[id(pilot_qc)]
+            if isinstance(index, slice):
+                flags_timesub = flags[index]
+                np.maximum(flags_timesub, pilot_qc['value'], out=flags_timesub)
+            else:
+                flags_timesub = flags[index]
+                flags_timesub[flags_timesub < pilot_qc['value']] = pilot_qc['value']
+                flags[index] = flags_timesub
+            pilot_comment = pilot_qc["comment"]
+            pilot_comments.append(f"Pilot QC: {pilot_comment} {time_str}. Minimum QC value set to {pilot_qc['value']}.")
+            _log.info(f"applied pilot QC to {variable}, min value {pilot_qc['value']} {time_str}")
         original_comment = var_qc.attrs["comment"]
-        pilot_comment = pilot_qc["comment"]
-        comment = f"Pilot QC: {pilot_comment} {time_str}. Minimum QC value set to {pilot_qc['value']}. IOOS_QC: {original_comment}"
+        comment = f"{' '.join(pilot_comments)} IOOS_QC: {original_comment}"
         var_qc.attrs["comment"] = comment
-        _log.info(f"applied pilot QC to {variable}, min value {pilot_qc['value']}")
     return ds
 
 
-def flagger(ds):
-    ds = flag_ioos(ds)
+def flagger(ds, qc_cache=None, chunk_size=None, workers=None, store_tests=False):
+    ds = flag_ioos(ds, qc_cache=qc_cache, chunk_size=chunk_size, workers=workers, store_tests=store_tests)
+    ds = flag_climatology(ds)
     ds = flag_oxygen(ds)
     ds = flag_pilot(ds)
     ds.attrs["processing_level"] = f"L1. Quality control flags from IOOS QC QARTOD https://github.com/ioos/ioos_qc " \
@@ -0,0 +1,179 @@
+import numpy as np
+import logging
+from votoutils.qc.batch_qartod import GOOD, SUSPECT, FAIL, MISSING, _as_float, aggregate_flags, batch_flags, \
+    register_qc_test
+from votoutils.qc.flag_qartod import cond_temp_vars
+
+_log = logging.getLogger(__name__)
+
+
+def get_profile_configs():
+    configs = {
+        "temperature": {
+            "temperature": {
+                "profile": {
+                    "profile_flat_line_test": {"tolerance": 0.00001, "suspect_threshold": 300,
+                                               "fail_threshold": 900},
+                    "profile_rate_of_change_test": {"threshold": 0.5, "fail_threshold": 1.0},
+                }
+            },
+            "potential_density": {
+                "profile": {
+                    "profile_density_inversion_test": {"suspect_threshold": -0.03, "fail_threshold": -0.1},
+                }
+            },
+        },
+        "salinity": {
+            "salinity": {
+                "profile": {
+                    "profile_flat_line_test": {"tolerance": 0.00001, "suspect_threshold": 300,
+                                               "fail_threshold": 900},
+                    "profile_rate_of_change_test": {"threshold": 0.2, "fail_threshold": 0.5},
+                }
+            },
+            "potential_density": {
+                "profile": {
+                    "profile_density_inversion_test": {"suspect_threshold": -0.03, "fail_threshold": -0.1},
+                }
+            },
+        },
+        "oxygen_concentration": {
+            "oxygen_concentration": {
+                "profile": {
+                    "profile_flat_line_test": {"tolerance": 0.001, "suspect_threshold": 600,
+                                               "fail_threshold": 1800},
+                    "profile_rate_of_change_test": {"threshold": 5, "fail_threshold": 10},
+                }
+            }
+        },
+    }
+    return configs
+
+
+def derive_profile_configs(configs):
+    for var in cond_temp_vars:
+        configs[var] = {**configs["temperature"], **configs["salinity"]}
+    return configs
+
+
+def to_seconds(time):
+    time = np.asarray(time)
+    if np.issubdtype(time.dtype, np.datetime64):
+        return (time - time[0]) / np.timedelta64(1, "s")
+    return _as_float(time)
+
+
+def profile_pairs(profile_index, valid):
+    """
+    Indices of the valid samples, and whether each consecutive pair of valid samples is in the same profile.
+    Tests compare consecutive valid samples, so gaps from sensors sampling at different rates are skipped over
+    """
+    idx = np.flatnonzero(valid)
+    profile_index = np.asarray(profile_index)[idx]
+    same_profile = profile_index[1:] == profile_index[:-1]
+    return idx, same_profile
+
+
+def profile_density_inversion_flags(inp, pressure, profile_index, suspect_threshold=None, fail_threshold=None):
+    """
+    Density inversion test within each profile, as ioos_qc.qartod.density_inversion_test. Both samples either side of
+    a downward density change below the threshold (e.g. -0.03 kg m-3) are flagged
+    """
+    inp = _as_float(inp)
+    pressure = _as_float(pressure)
+    idx, same_profile = profile_pairs(profile_index, np.isfinite(inp) & np.isfinite(pressure))
+    flags = np.full(inp.shape, MISSING, dtype=np.uint8)
+    sub_flags = np.full(len(idx), GOOD, dtype=np.uint8)
+    delta = np.sign(np.diff(pressure[idx])) * np.diff(inp[idx])
+    for threshold, flag in ((suspect_threshold, SUSPECT), (fail_threshold, FAIL)):
+        if threshold is None:
+            continue
+        inverted = same_profile & (delta < threshold)
+        sub_flags[:-1][inverted] = flag
+        sub_flags[1:][inverted] = flag
+    flags[idx] = sub_flags
+    return flags
+
+
+def profile_flat_line_flags(inp, time, profile_index, tolerance, suspect_threshold, fail_threshold):
+    """
+    Flat line test within each profile. Runs of consecutive valid samples that each change by no more than tolerance
+    are flagged if the run lasts longer than the thresholds, in seconds. Unlike ioos_qc.qartod.flat_line_test, the
+    whole run is flagged, including the samples before the threshold was reached
+    """
+    inp = _as_float(inp)
+    seconds = to_seconds(time)
+    idx, same_profile = profile_pairs(profile_index, np.isfinite(inp) & np.isfinite(seconds))
+    flags = np.full(inp.shape, MISSING, dtype=np.uint8)
+    if not len(idx):
+        return flags
+    flat = same_profile & (np.abs(np.diff(inp[idx])) <= tolerance)
+    run_starts = np.flatnonzero(np.concatenate(([True], ~flat)))
+    run_ends = np.append(run_starts[1:] - 1, len(idx) - 1)
+    run_seconds = seconds[idx][run_ends] - seconds[idx][run_starts]
+    sample_run_seconds = np.repeat(run_seconds, run_ends - run_starts + 1)
+    sub_flags = np.full(len(idx), GOOD, dtype=np.uint8)
+    sub_flags[sample_run_seconds > suspect_threshold] = SUSPECT
+    sub_flags[sample_run_seconds > fail_threshold] = FAIL
+    flags[idx] = sub_flags
+    return flags
+
+
+def profile_rate_of_change_flags(inp, time, profile_index, threshold, fail_threshold=None):
+    """
+    Rate of change test within each profile, as ioos_qc.qartod.rate_of_change_test. The rate between consecutive
+    valid samples, in units per second, flags the later sample. The first sample of each profile is not compared with
+    the end of the previous profile
+    """
+    inp = _as_float(inp)
+    seconds = to_seconds(time)
+    idx, same_profile = profile_pairs(profile_index, np.isfinite(inp) & np.isfinite(seconds))
+    flags = np.full(inp.shape, MISSING, dtype=np.uint8)
+    if not len(idx):
+        return flags
+    dt = np.diff(seconds[idx])
+    compare = same_profile & (dt > 0)
+    rate = np.zeros(len(idx) - 1)
+    rate[compare] = np.abs(np.diff(inp[idx])[compare] / dt[compare])
+    sub_flags = np.full(len(idx), GOOD, dtype=np.uint8)
+    sub_flags[1:][rate > threshold] = SUSPECT
+    if fail_threshold is not None:
+        sub_flags[1:][rate > fail_threshold] = FAIL
+    flags[idx] = sub_flags
+    return flags
+
+
+register_qc_test("profile_density_inversion_test", profile_density_inversion_flags,
+                 ("suspect_threshold", "fail_threshold"), halo=None, inputs=("pressure", "profile_index"),
+                 module="profile")
+register_qc_test("profile_flat_line_test", profile_flat_line_flags,
+                 ("tolerance", "suspect_threshold", "fail_threshold"), halo=None, inputs=("time", "profile_index"),
+                 module="profile")
+register_qc_test("profile_rate_of_change_test", profile_rate_of_change_flags, ("threshold", "fail_threshold"),
+                 halo=None, inputs=("time", "profile_index"), module="profile")
+
+
+def flag_profiles(ds):
+    """
+    Run the profile-segmented tests in get_profile_configs and merge their flags into the existing *_qc variables
+    by QARTOD precedence. Needs profile_index, so run after set_profile_numbers
+    """
+    if "profile_index" not in list(ds.variables):
+        _log.warning("No profile_index in dataset. Skipping profile QC")
+        return ds
+    configs = derive_profile_configs(get_profile_configs())
+    run_configs = {}
+    for config_name, config in configs.items():
+        if f"{config_name}_qc" not in list(ds):
+            _log.warning(f"{config_name}_qc not found in dataset. Skipping profile QC")
+            continue
+        run_configs[config_name] = config
+    profile_flags = batch_flags(ds, run_configs)
+    for config_name, flags in profile_flags.items():
+        flagged_prop = 100 * np.sum(np.logical_and(flags > 1, flags < 9)) / len(flags)
+        _log.info(f"Profile QC flagged {flagged_prop.round(3)} % of {config_name} as bad")
+        var_qc = ds[f"{config_name}_qc"]
+        var_qc.values = aggregate_flags([var_qc.values.astype(np.uint8), flags]).astype(var_qc.dtype)
+        tests = sorted({test for stream in run_configs[config_name].values() for test in stream["profile"]})
+        var_qc.attrs["comment"] = f"{var_qc.attrs['comment']} Profile QC by profile_index: {', '.join(tests)}."
+    return ds
@@ -0,0 +1,171 @@
+import pathlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging
+from votoutils.qc.batch_qartod import spike_diff, _as_float
+
+_log = logging.getLogger(__name__)
+
+
+def dive_codes(ds):
+    """Integer code for each sample's dive, and the dive numbers. Samples without a dive get code -1"""
+    dive_num = ds["dive_num"].values.astype(np.float64)
+    valid = np.isfinite(dive_num)
+    dives, codes = np.unique(np.around(dive_num[valid]).astype(int), return_inverse=True)
+    all_codes = np.full(dive_num.shape, -1, dtype=np.int64)
+    all_codes[valid] = codes
+    return all_codes, dives
+
+
+def count_by_dive(codes, bins, num_dives, num_bins):
+    """Number of samples in each (dive, bin) pair, as a num_dives x num_bins array"""
+    valid = codes >= 0
+    flat = codes[valid] * num_bins + bins[valid]
+    return np.bincount(flat, minlength=num_dives * num_bins).reshape(num_dives, num_bins)
+
+
+def count_above(stat, codes, num_dives, thresholds):
+    """Per dive count of samples with stat > threshold, for every threshold. Returns num_dives x len(thresholds)"""
+    order = np.argsort(thresholds)
+    sorted_thresholds = np.asarray(thresholds, dtype=np.float64)[order]
+    # bin b holds samples greater than the b lowest thresholds
+    bins = np.searchsorted(sorted_thresholds, stat, side="left")
+    counts = count_by_dive(codes, bins, num_dives, len(thresholds) + 1)
+    above = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    result = np.empty_like(above)
+    result[:, order] = above
+    return result
+
+
+def count_below(stat, codes, num_dives, thresholds):
+    """Per dive count of samples with stat < threshold, for every threshold. Returns num_dives x len(thresholds)"""
+    order = np.argsort(thresholds)
+    sorted_thresholds = np.asarray(thresholds, dtype=np.float64)[order]
+    # bin b holds samples at or above the b lowest thresholds
+    bins = np.searchsorted(sorted_thresholds, stat, side="right")
+    counts = count_by_dive(codes, bins, num_dives, len(thresholds) + 1)
+    below = np.cumsum(counts, axis=1)[:, :-1]
+    result = np.empty_like(below)
+    result[:, order] = below
+    return result
+
+
+def sweep_variable(ds, variable, tests, codes, num_dives):
+    """
+    Flagged sample counts per dive for every setting in tests
+    :return: list of (test, setting, flagged counts per dive, tested samples per dive)
+    """
+    inp = _as_float(ds[variable].values)
+    sweeps = []
+    for test_name, test_grid in tests.items():
+        if test_name == "gross_range_test":
+            spans = [sorted(span) for span in test_grid["span"]]
+            # as in the gross range test, infinite values fail. NaN would sort above every threshold, so drop
+            # missing samples from the dive codes before counting
+            tested_codes = np.where(np.isnan(inp), -1, codes)
+            stat = inp
+            below = count_below(stat, tested_codes, num_dives, [span[0] for span in spans])
+            above = count_above(stat, tested_codes, num_dives, [span[1] for span in spans])
+            tested = np.bincount(tested_codes[tested_codes >= 0], minlength=num_dives)
+            for i, span in enumerate(spans):
+                sweeps.append((test_name, f"span={span}", below[:, i] + above[:, i], tested))
+        elif test_name == "spike_test":
+            diff, ref_missing = spike_diff(inp)
+            defined = np.isfinite(inp) & ~ref_missing
+            if len(defined):
+                defined[0] = False
+                defined[-1] = False
+            tested_codes = np.where(defined, codes, -1)
+            thresholds = list(test_grid["threshold"])
+            above = count_above(np.where(defined, diff, -np.inf), tested_codes, num_dives, thresholds)
+            tested = np.bincount(tested_codes[tested_codes >= 0], minlength=num_dives)
+            for i, threshold in enumerate(thresholds):
+                sweeps.append((test_name, f"threshold={threshold}", above[:, i], tested))
+        else:
+            raise ValueError(f"Threshold sweep not supported for {test_name}")
+    return sweeps
+
+
+def sweep_thresholds(ds, grid):
+    """
+    Evaluate a grid of QC thresholds against a mission in one vectorized pass per variable and test.
+    Each test statistic is computed once, binned against the sorted thresholds and counted per dive, so the cost
+    barely grows with the number of settings.
+    :param ds: glider timeseries dataset with dive_num
+    :param grid: dict of variable: {test: settings}. gross_range_test takes {"span": [[min, max], ...]},
+     spike_test takes {"threshold": [value, ...]}. A sample counts as flagged if it would fail a test with that span
+     or threshold
+    :return: DataFrame with one row per variable, test, setting and dive
+    """
+    codes, dives = dive_codes(ds)
+    num_dives = len(dives)
+    frames = []
+    for variable, tests in grid.items():
+        if variable not in list(ds.variables):
+            _log.warning(f"{variable} not found in dataset. Skipping")
+            continue
+        for test_name, setting, flagged, tested in sweep_variable(ds, variable, tests, codes, num_dives):
+            with np.errstate(invalid="ignore", divide="ignore"):
+                fraction = flagged / tested
+            frames.append(pd.DataFrame({"variable": variable, "test": test_name, "setting": setting,
+                                        "dive_num": dives, "samples": tested, "flagged": flagged,
+                                        "flagged_fraction": fraction}))
+    if not frames:
+        return pd.DataFrame(columns=["variable", "test", "setting", "dive_num", "samples", "flagged",
+                                     "flagged_fraction"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def mission_summary(df_sweep):
+    """Collapse the per-dive sweep table to the flagged fraction of the whole mission for each setting"""
+    df = df_sweep.groupby(["variable", "test", "setting"], sort=False)[["samples", "flagged"]].sum()
+    df["flagged_fraction"] = df.flagged / df.samples
+    return df.reset_index()
+
+
+def sweep_grid_from_configs(configs, scales=(0.5, 0.75, 1, 1.5, 2)):
+    """
+    Build a sweep grid around the thresholds in a set of QC configs, e.g. from flag_qartod.get_configs.
+    Spike thresholds are multiplied by each scale, gross range spans are scaled about their centre.
+    Both the suspect and fail settings of the config are used as starting points
+    """
+    grid = {}
+    for config in configs.values():
+        for variable, var_config in config.items():
+            for test_name, kwargs in var_config.get("qartod", {}).items():
+                if test_name == "gross_range_test":
+                    spans = grid.setdefault(variable, {}).setdefault(test_name, {"span": []})["span"]
+                    for key in ("suspect_span", "fail_span"):
+                        if key not in kwargs:
+                            continue
+                        low, high = sorted(kwargs[key])
+                        centre, half_width = (low + high) / 2, (high - low) / 2
+                        for scale in scales:
+                            span = [centre - half_width * scale, centre + half_width * scale]
+                            if span not in spans:
+                                spans.append(span)
+                elif test_name == "spike_test":
+                    thresholds = grid.setdefault(variable, {}).setdefault(test_name, {"threshold": []})["threshold"]
+                    for key in ("suspect_threshold", "fail_threshold"):
+                        if not kwargs.get(key):
+                            continue
+                        for scale in scales:
+                            threshold = kwargs[key] * scale
+                            if threshold not in thresholds:
+                                thresholds.append(threshold)
+    return grid
+
+
+def sweep_files(nc_files, grid):
+    """Run sweep_thresholds over many timeseries files, e.g. the fleet archive, adding a dataset_id column"""
+    frames = []
+    for nc_file in nc_files:
+        _log.info(f"sweep QC thresholds for {nc_file}")
+        variables = ["dive_num"] + list(grid.keys())
+        with xr.open_dataset(nc_file) as ds:
+            ds = ds[[var for var in variables if var in ds.variables]].load()
+        df = sweep_thresholds(ds, grid)
+        df.insert(0, "dataset_id", ds.attrs.get("dataset_id", pathlib.Path(nc_file).stem))
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
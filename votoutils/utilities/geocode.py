@@ -5,10 +5,13 @@ import polars as pl
 import logging
 import pathlib
 import argparse
-import shutil
 import numpy as np
+import shapely
 from itertools import chain
-from collections import Counter
+from collections import Counter, namedtuple
+from votoutils.utilities.geometry_store import load_geometry_store, contains_pairs, raster_lookup, \
+    to_layer_crs
+from votoutils.utilities.nc_metadata import patch_nc_attrs, patch_ncs
 _log = logging.getLogger(__name__)
 
 comment = "Data points for this variable that fall within Swedish territorial seas have been removed." \
@@ -40,30 +43,70 @@ def get_seas_merged_nav_nc(navfile):
     return locs_to_seas(lon, lat)
 
 
+# Positions are rounded to this many decimals of a degree, about 1 m, and deduplicated before basin lookup
+basin_position_decimals = 5
+# HELCOM basin of each position as an index into names, -1 outside all basins, and the basins as a comma separated
+# string, most frequent first
+BasinTags = namedtuple("BasinTags", "codes names summary")
+
+
+def locate_basins(lon, lat, decimals=basin_position_decimals):
+    """
+    HELCOM basins of positions. Glider fixes repeat the same few positions many times, so positions are rounded to
+    decimals and each distinct position is tested once, with shapely contains_xy against the prepared basin polygons
+    :return: BasinTags. codes index the polygons of the basin layer, in names, and hold the first polygon that contains
+     each position. The summary counts a position in every basin that contains it, so where basin polygons overlap
+     the summary can name basins that no code refers to
+    """
+    layer = load_geometry_store()["helcom"]
+    names = layer.attributes["Name"]
+    lon, lat = np.asarray(lon, dtype=float).ravel(), np.asarray(lat, dtype=float).ravel()
+    codes = np.full(len(lon), -1, dtype=np.int16)
+    positioned = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    scale = 10 ** decimals
+    lon_key = np.round(lon[positioned] * scale).astype(np.int64)
+    lat_key = np.round(lat[positioned] * scale).astype(np.int64)
+    position_index, keys = pd.factorize(lon_key * 2 ** 32 + lat_key)
+    repeats = np.bincount(position_index, minlength=len(keys))
+    lat_key = (keys + 2 ** 31) % 2 ** 32 - 2 ** 31
+    x, y = to_layer_crs(layer, ((keys - lat_key) >> 32) / scale, lat_key / scale)
+    position_codes = np.full(len(keys), -1, dtype=np.int16)
+    basin_counts = Counter()
+    # in reverse, so positions in several basins get the code of the first
+    for index in range(len(names))[::-1]:
+        x_min, y_min, x_max, y_max = shapely.bounds(layer.geometries[index])
+        candidates = np.flatnonzero((x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+        inside = candidates[shapely.contains_xy(layer.geometries[index], x[candidates], y[candidates])]
+        position_codes[inside] = index
+        basin_counts[index] = int(repeats[inside].sum())
+    codes[positioned] = position_codes[position_index]
+    name_counts = Counter()
+    for index in sorted(basin_counts):
+        if basin_counts[index]:
+            name_counts[names[index]] += basin_counts[index]
+    summary = ", ".join(name for name, __ in name_counts.most_common())
+    return BasinTags(codes, names, summary)
+
+
 def locs_to_seas(lon, lat):
-    df_helcom = gp.read_file("/data/third_party/helcom_plus_skag/helcom_plus_skag.shp")
-    df_glider = pd.DataFrame({"lon": lon, "lat": lat})
-    df_glider = gp.GeoDataFrame(df_glider, geometry=gp.points_from_xy(df_glider.lon, df_glider.lat))
-    df_glider = df_glider.set_crs(epsg=4326)
-    df_glider = df_glider.to_crs(df_helcom.crs)
-    polygons_contains = gp.sjoin(df_helcom, df_glider, predicate='contains')
-    basin_points = polygons_contains.Name.values
-    basin_counts = Counter(basin_points).most_common()
-    if not basin_counts:
-        return ""
-    basins_ordered = [x[0] for x in basin_counts]
-    basin_str = ", ".join(basins_ordered)
-    return basin_str
-
-
-def nc_add_sea(nc_path, basin_str, tempfile):
-    _log.info(f"working on {nc_path}")
-    ds = xr.open_dataset(nc_path)
-    meta = ds.attrs
-    meta["basin"] = basin_str
-    ds.attrs = meta
-    ds.to_netcdf(tempfile)
-    shutil.move(tempfile, nc_path)
+    """HELCOM basins containing the positions, most frequent first, as a comma separated string"""
+    return locate_basins(lon, lat).summary
+
+
+def add_sample_basins(ds):
+    """Add the HELCOM basin of each sample as a flag variable, basin. Stored as int16, as set_best_dtype would store
+    it, so flag_values keep the type of the variable"""
+    tags = locate_basins(ds["longitude"].values, ds["latitude"].values)
+    ds["basin"] = ("time", tags.codes.astype(np.int16),
+                   {"long_name": "HELCOM basin", "flag_values": np.arange(-1, len(tags.names), dtype=np.int16),
+                    "flag_meanings": " ".join(["none"] + [name.replace(" ", "_") for name in tags.names]),
+                    "sources": "longitude, latitude",
+                    "comment": "HELCOM sub-basins extended with the Skagerrak, from each sample's position"})
+    return ds
+
+
+def nc_add_sea(nc_path, basin_str, tempfile=None):
+    patch_nc_attrs(nc_path, {"basin": basin_str}, tempfile=tempfile)
 
 
 def update_ncs(glider, mission, sub_dir):
@@ -81,41 +124,36 @@ def update_ncs(glider, mission, sub_dir):
     gridfile = list(gridfile_dir.glob("*.nc"))[0]
     basin = get_seas(gridfile)
     _log.info(f"Basin: {basin}")
-    for nc in nc_files_flat:
-        temp_nc = pathlib.Path("/data/tmp") / pathlib.Path(nc).name
-        nc_add_sea(nc, basin, temp_nc)
+    patch_ncs(nc_files_flat, {"basin": basin})
     _log.info(f"Updated all ncs in {root_dir}")
     _log.info("Success! added basin to all ncs")
 
 
+def dive_positions(ds):
+    """Mean position of each dive, indexed by dive_num"""
+    return ds[["longitude", "latitude", "dive_num"]].to_pandas().groupby("dive_num").mean()
+
+
+def polygon_matches(layer, df_glider, column):
+    """dive_num and the attribute column of each polygon of the layer that contains a dive's mean position"""
+    polygon_index, point_index = contains_pairs(layer, df_glider.longitude.values, df_glider.latitude.values)
+    return pd.DataFrame({"dive_num": df_glider.index.values[point_index],
+                         column: layer.attributes[column][polygon_index]})
+
+
 def geocode_by_dives(ds):
-    # read in shapefiles
-    df_helcom = gp.read_file("/data/third_party/helcom_plus_skag/helcom_plus_skag.shp")
-    df_12nm = gp.read_file("/data/third_party/eez_12nm/eez_12nm_filled.geojson")
-    # extend the Swedish territorial waters by a buffer lenght
-    df_12nm_extend = df_12nm.copy()
-    df_12nm_extend = df_12nm_extend.to_crs('epsg:3152')
-    # add buffer of 0.5 nm
-    buffer_length_in_meters = 0.5 * 1852
-    df_12nm_extend['geometry'] = df_12nm_extend.geometry.buffer(buffer_length_in_meters)
-    df_12nm_extend_in = df_12nm_extend.to_crs(epsg=4326)
+    # load the prepared HELCOM basins, 12 nm territorial seas and the territorial seas extended by a 0.5 nm buffer
+    store = load_geometry_store()
     # Create minimal dataset and group it by dives
-    ds = ds[["longitude", "latitude", "dive_num"]]
-    df_glider = ds.to_pandas().groupby("dive_num").mean()
+    df_glider = dive_positions(ds)
     df_glider = gp.GeoDataFrame(df_glider, geometry=gp.points_from_xy(df_glider.longitude, df_glider.latitude))
-    # Align crs and check which dives fall within Swedish 12 nm waters and helcom polygons
     df_glider = df_glider.set_crs(epsg=4326)
-    df_helcom = df_helcom.to_crs(df_glider.crs)
-    df_helcom = gp.sjoin(df_helcom, df_glider, predicate='contains')
-    df_12nm = df_12nm.to_crs(df_glider.crs)
-    df_12nm = gp.sjoin(df_12nm, df_glider, predicate='contains')
-    df_12nm_extend = df_12nm_extend_in.to_crs(df_glider.crs)
-    df_12nm_extend = gp.sjoin(df_12nm_extend, df_glider, predicate='contains')
+    # check which dives fall within Swedish 12 nm waters and helcom polygons
+    df_12nm_id = polygon_matches(store["eez_12nm"], df_glider, "sovereign1")
+    df_helcom_id = polygon_matches(store["helcom_wgs84"], df_glider, "Name")
+    df_12nm_extend_id = polygon_matches(store["eez_12nm_buffered"], df_glider, "sovereign1")
     df_glider.index.rename("index", inplace=True)
     df_glider["dive_num"] = df_glider.index
-    df_12nm_id = df_12nm[["dive_num", "sovereign1"]]
-    df_helcom_id = df_helcom[["dive_num", "Name"]]
-    df_12nm_extend_id = df_12nm_extend[["dive_num", "sovereign1"]]
     df_12nm_extend_id = df_12nm_extend_id.rename(columns={"dive_num": "dive_num_extend",
                                                           "sovereign1": "sovereign1_extend"})
     # merge the resulting dataframes and check that dives numbers still align
@@ -131,6 +169,14 @@ def geocode_by_dives(ds):
     return df_glider
 
 
+def dive_basins(ds):
+    """HELCOM basin of each dive from the dive's mean position. Returns a Series of basin names indexed by dive_num"""
+    df_glider = dive_positions(ds)
+    df_basin = polygon_matches(load_geometry_store()["helcom"], df_glider, "Name")
+    df_basin = df_basin[~df_basin.dive_num.duplicated()].set_index("dive_num")
+    return df_basin["Name"].reindex(df_glider.index)
+
+
 def identify_territorial_dives(ds, df_geocode):
     international_dives = df_geocode.loc[df_geocode.sovereign1_extend == "International waters", "dive_num"]
     good_dives = np.empty((np.size(ds.dive_num.values)), dtype=bool)
@@ -139,25 +185,45 @@ def identify_territorial_dives(ds, df_geocode):
     return good_dives
 
 
-def filter_territorial_data(ds):
-    df_geocode = geocode_by_dives(ds)
-    good_dives = identify_territorial_dives(ds, df_geocode)
+def territorial_mask(ds, variables=None, per_sample=False):
+    """
+    Samples from dives within Swedish territorial seas, and the variables they must be removed from
+    :param variables: names of the variables to check. Defaults to the variables of ds. May include variables that are
+     not yet in ds, e.g. derived variables that are computed later
+    :param per_sample: decide for each sample from its own position with the geometry raster, instead of for each
+     dive from the dive's mean position. Samples without a position are kept
+    :return: boolean array, True for samples to remove, and list of variable names. None and [] if no dives found
+    """
+    if per_sample:
+        __, territorial = raster_lookup(ds["longitude"].values, ds["latitude"].values)
+        good_dives = ~territorial
+    else:
+        df_geocode = geocode_by_dives(ds)
+        good_dives = identify_territorial_dives(ds, df_geocode)
     if all(good_dives):
         _log.info("No dives found within Swedish territorial waters")
-        return ds
+        return None, []
     else:
         percent_remove = sum(~good_dives) / len(good_dives) * 100
         _log.warning(f"Dives found within Swedish territorial seas. Will remove {int(percent_remove)} % of data")
     flag_terms = ["adcp", "ad2cp", "altitude", "altimeter", "altim", "velocity", "amplitude", "bathy", "bathymetry",
                   "seafloor"]
-    for var_name in list(ds):
+    var_names = []
+    for var_name in list(ds) if variables is None else variables:
         if not any(substring in var_name.lower() for substring in flag_terms):
             continue
-        if ds[var_name].dtype == np.dtype('<M8[ns]'):
+        if var_name in list(ds) and ds[var_name].dtype == np.dtype('<M8[ns]'):
             _log.warning(f"Will not flag territorial seas for {var_name}. dtype is {ds[var_name].dtype}")
             continue
+        var_names.append(var_name)
+    return ~good_dives, var_names
+
+
+def filter_territorial_data(ds, per_sample=False):
+    bad_samples, var_names = territorial_mask(ds, per_sample=per_sample)
+    for var_name in var_names:
         _log.info(f"Flag territorial seas for {var_name}")
-        ds[var_name].values[~good_dives] = np.nan
+        ds[var_name].values[bad_samples] = np.nan
         ds[var_name].attrs["comment"] = f'{ds[var_name].attrs["comment"]}. {comment}'
     return ds
 
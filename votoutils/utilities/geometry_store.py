@@ -0,0 +1,304 @@
+import hashlib
+import logging
+import pathlib
+import tempfile
+import zipfile
+from collections import namedtuple
+import geopandas as gp
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+_log = logging.getLogger(__name__)
+
+helcom_file = "/data/third_party/helcom_plus_skag/helcom_plus_skag.shp"
+eez_12nm_file = "/data/third_party/eez_12nm/eez_12nm_filled.geojson"
+geometry_store_dir = "/data/tmp/geometry_store"
+# Swedish territorial waters are extended by this buffer, applied in EPSG:3152 (SWEREF99)
+territorial_buffer_meters = 0.5 * 1852
+
+# Polygons of one layer of the store, their attribute columns, coordinate reference system and STRtree index.
+# The geometries are prepared, so repeated predicates against them are fast
+GeometryLayer = namedtuple("GeometryLayer", "geometries attributes crs tree")
+# columns kept from each layer
+layer_attributes = {"helcom": ["Name"], "helcom_wgs84": ["Name"], "eez_12nm": ["sovereign1"],
+                    "eez_12nm_buffered": ["sovereign1"]}
+_geometry_stores = {}
+
+# Raster of the Baltic and Skagerrak in EPSG:4326: lon_min, lat_min, lon_max, lat_max and cell size in degrees
+raster_bounds = (7.5, 53.0, 30.5, 66.0)
+raster_resolution = 0.005
+# Raster cell codes. A cell that a polygon boundary passes through is resolved per point against the polygons
+no_polygon = -1
+straddles_boundary = -2
+# Basin index into the helcom_wgs84 layer and Swedish territorial seas state (0 outside, 1 inside the buffered 12 nm
+# limit) of each raster cell, in rows of latitude and columns of longitude
+GeometryRaster = namedtuple("GeometryRaster", "basin territorial bounds resolution")
+_geometry_rasters = {}
+
+
+def source_files(path):
+    """The file at path and its sidecar files, e.g. the .dbf, .shx and .prj of a shapefile"""
+    path = pathlib.Path(path)
+    return sorted(path.parent.glob(f"{path.stem}.*"))
+
+
+def source_stats(paths):
+    return tuple((str(source), source.stat().st_mtime_ns, source.stat().st_size) for path in paths
+                 for source in source_files(path))
+
+
+def source_fingerprint(paths):
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        for source in source_files(path):
+            digest.update(source.name.encode())
+            digest.update(source.read_bytes())
+    return digest.hexdigest()
+
+
+def build_geometry_layers(helcom_path=helcom_file, eez_12nm_path=eez_12nm_file):
+    """
+    Read the HELCOM basins and 12 nm territorial seas and derive the layers used for geocoding:
+    helcom in its own crs, helcom_wgs84, eez_12nm in EPSG:4326 and eez_12nm_buffered, the territorial seas extended
+    by territorial_buffer_meters
+    :return: dict of layer name to GeoDataFrame
+    """
+    df_helcom = gp.read_file(helcom_path)
+    df_12nm = gp.read_file(eez_12nm_path)
+    df_12nm_extend = df_12nm.to_crs('epsg:3152')
+    df_12nm_extend['geometry'] = df_12nm_extend.geometry.buffer(territorial_buffer_meters)
+    return {"helcom": df_helcom,
+            "helcom_wgs84": df_helcom.to_crs(epsg=4326),
+            "eez_12nm": df_12nm.to_crs(epsg=4326),
+            "eez_12nm_buffered": df_12nm_extend.to_crs(epsg=4326)}
+
+
+def write_npz(path, arrays, compressed=False):
+    """Write arrays to path through a uniquely named temporary file in the same directory, so readers never see a
+    partial file and processes writing the same file at once do not write into one temporary file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False) as fout:
+        temp_path = pathlib.Path(fout.name)
+        try:
+            (np.savez_compressed if compressed else np.savez)(fout, **arrays)
+        except BaseException:
+            fout.close()
+            temp_path.unlink()
+            raise
+    temp_path.replace(path)
+
+
+def save_geometry_layers(layers, store_path):
+    """Write the layers to a npz of WKB bytes with offsets, attribute columns as strings and the crs as WKT"""
+    arrays = {}
+    for name, df in layers.items():
+        wkb = shapely.to_wkb(df.geometry.values)
+        arrays[f"{name}_offsets"] = np.cumsum([0] + [len(geometry) for geometry in wkb])
+        arrays[f"{name}_wkb"] = np.frombuffer(b"".join(wkb), dtype=np.uint8)
+        arrays[f"{name}_crs"] = np.array(df.crs.to_wkt())
+        for column in layer_attributes[name]:
+            arrays[f"{name}_{column}"] = np.asarray(df[column].astype(str), dtype=str)
+    write_npz(store_path, arrays)
+
+
+def read_geometry_layers(store_path):
+    layers = {}
+    with np.load(store_path) as stored:
+        for name, columns in layer_attributes.items():
+            offsets = stored[f"{name}_offsets"]
+            wkb = stored[f"{name}_wkb"].tobytes()
+            geometries = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+            layers[name] = (geometries, {column: stored[f"{name}_{column}"] for column in columns},
+                            str(stored[f"{name}_crs"]))
+    return layers
+
+
+def index_layer(geometries, attributes, crs):
+    geometries = np.asarray(geometries)
+    shapely.prepare(geometries)
+    return GeometryLayer(geometries, attributes, CRS.from_user_input(crs), shapely.STRtree(geometries))
+
+
+def load_geometry_store(helcom_path=helcom_file, eez_12nm_path=eez_12nm_file, store_dir=geometry_store_dir):
+    """
+    Geocoding layers, built from the source files once and then read from store_dir, where they are keyed by a hash
+    of the source files. Kept in memory for the life of the process while the source files are unchanged. If
+    store_dir is not writable the layers are only kept in memory
+    :return: dict of layer name to GeometryLayer
+    """
+    paths = (helcom_path, eez_12nm_path)
+    stats = source_stats(paths)
+    if stats in _geometry_stores:
+        return _geometry_stores[stats]
+    store_path = pathlib.Path(store_dir) / f"geometry_{source_fingerprint(paths)}.npz"
+    layers = None
+    if store_path.exists():
+        try:
+            layers = read_geometry_layers(store_path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile, shapely.errors.GEOSException) as err:
+            _log.warning(f"Could not read geometry store {store_path}: {err}. Rebuilding")
+    if layers is None:
+        _log.info(f"building geometry store from {', '.join(paths)}")
+        dataframes = build_geometry_layers(helcom_path, eez_12nm_path)
+        try:
+            save_geometry_layers(dataframes, store_path)
+        except OSError as err:
+            _log.warning(f"Could not write geometry store to {store_dir}: {err}")
+        layers = {name: (df.geometry.values, {column: np.asarray(df[column].astype(str), dtype=str)
+                                              for column in layer_attributes[name]}, df.crs.to_wkt())
+                  for name, df in dataframes.items()}
+    store = {name: index_layer(*layer) for name, layer in layers.items()}
+    _geometry_stores[stats] = store
+    return store
+
+
+def to_layer_crs(layer, lon, lat):
+    """Coordinates of positions in degrees east and north in the crs of the layer"""
+    x, y = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    if not layer.crs.equals(CRS.from_epsg(4326)):
+        x, y = Transformer.from_crs(4326, layer.crs, always_xy=True).transform(x, y)
+    return x, y
+
+
+def contains_pairs(layer, lon, lat):
+    """
+    Polygons of the layer that contain each point, as gp.sjoin(polygons, points, predicate='contains')
+    :param lon: longitudes of the points, degrees east
+    :param lat: latitudes of the points, degrees north
+    :return: polygon indices and point indices of the matches, sorted by polygon then point
+    """
+    x, y = to_layer_crs(layer, lon, lat)
+    point_index, polygon_index = layer.tree.query(shapely.points(x, y), predicate="within")
+    order = np.lexsort((point_index, polygon_index))
+    return polygon_index[order], point_index[order]
+
+
+def first_polygon(layer, lon, lat):
+    """Index of the first polygon of the layer containing each point, no_polygon if none does"""
+    polygon_index, point_index = contains_pairs(layer, lon, lat)
+    order = np.lexsort((polygon_index, point_index))
+    points, first_match = np.unique(point_index[order], return_index=True)
+    first = np.full(np.size(lon), no_polygon, dtype=np.int16)
+    first[points] = polygon_index[order][first_match]
+    return first
+
+
+def swedish_polygons(layer):
+    return np.flatnonzero(layer.attributes["sovereign1"] == "Sweden")
+
+
+def boundary_cells(geometries, shape, bounds=raster_bounds, resolution=raster_resolution):
+    """
+    Raster cells that a boundary of the geometries passes through. Boundaries are densified to half a cell, the cells
+    of their vertices marked, and the marks grown by one cell, so a boundary that clips the corner of a cell is caught
+    """
+    lon_min, lat_min = bounds[:2]
+    cells = np.zeros(shape, dtype=bool)
+    for geometry in geometries:
+        coords = shapely.get_coordinates(shapely.segmentize(shapely.boundary(geometry), resolution / 2))
+        rows = np.floor((coords[:, 1] - lat_min) / resolution).astype(int)
+        cols = np.floor((coords[:, 0] - lon_min) / resolution).astype(int)
+        keep = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        cells[rows[keep], cols[keep]] = True
+    grown = cells.copy()
+    for shift_row in (-1, 0, 1):
+        for shift_col in (-1, 0, 1):
+            grown[max(shift_row, 0):shape[0] + min(shift_row, 0), max(shift_col, 0):shape[1] + min(shift_col, 0)] |= \
+                cells[max(-shift_row, 0):shape[0] + min(-shift_row, 0), max(-shift_col, 0):shape[1] + min(-shift_col, 0)]
+    return grown
+
+
+def build_geometry_raster(store, bounds=raster_bounds, resolution=raster_resolution, block_rows=256):
+    """
+    Rasterize the HELCOM basins and the buffered Swedish territorial seas. Cells away from any boundary are classified
+    by their centre, which is exact for the whole cell. Cells on a boundary are marked straddles_boundary
+    """
+    lon_min, lat_min, lon_max, lat_max = bounds
+    shape = (int(round((lat_max - lat_min) / resolution)), int(round((lon_max - lon_min) / resolution)))
+    basins = store["helcom_wgs84"]
+    territorial_seas = store["eez_12nm_buffered"]
+    swedish = swedish_polygons(territorial_seas)
+    basin = np.full(shape, no_polygon, dtype=np.int16)
+    territorial = np.zeros(shape, dtype=np.int8)
+    lon_centres = lon_min + (np.arange(shape[1]) + 0.5) * resolution
+    for start in range(0, shape[0], block_rows):
+        lat_centres = lat_min + (np.arange(start, min(start + block_rows, shape[0])) + 0.5) * resolution
+        lon_block, lat_block = np.meshgrid(lon_centres, lat_centres)
+        block_basin = basin[start:start + block_rows]
+        # reversed, so the first polygon containing a cell is written last
+        for index in range(len(basins.geometries))[::-1]:
+            block_basin[shapely.contains_xy(basins.geometries[index], lon_block, lat_block)] = index
+        for index in swedish:
+            territorial[start:start + block_rows][shapely.contains_xy(territorial_seas.geometries[index], lon_block,
+                                                                      lat_block)] = 1
+    basin[boundary_cells(basins.geometries, shape, bounds, resolution)] = straddles_boundary
+    territorial[boundary_cells(territorial_seas.geometries, shape, bounds, resolution)] = straddles_boundary
+    return GeometryRaster(basin, territorial, np.array(bounds), resolution)
+
+
+def load_geometry_raster(helcom_path=helcom_file, eez_12nm_path=eez_12nm_file, store_dir=geometry_store_dir,
+                         resolution=raster_resolution):
+    """
+    Raster of the geometry store, built once and then read from store_dir, keyed by a hash of the source files and
+    the resolution. The raster at the default resolution takes about 36 MB
+    :return: GeometryRaster
+    """
+    paths = (helcom_path, eez_12nm_path)
+    key = (source_stats(paths), resolution)
+    if key in _geometry_rasters:
+        return _geometry_rasters[key]
+    store = load_geometry_store(helcom_path, eez_12nm_path, store_dir)
+    raster_path = pathlib.Path(store_dir) / f"raster_{source_fingerprint(paths)}_{resolution}.npz"
+    raster = None
+    if raster_path.exists():
+        try:
+            with np.load(raster_path) as stored:
+                raster = GeometryRaster(stored["basin"], stored["territorial"], stored["bounds"],
+                                        float(stored["resolution"]))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as err:
+            _log.warning(f"Could not read geometry raster {raster_path}: {err}. Rebuilding")
+    if raster is None:
+        _log.info(f"building geometry raster at {resolution} degrees")
+        raster = build_geometry_raster(store, resolution=resolution)
+        try:
+            write_npz(raster_path, raster._asdict(), compressed=True)
+        except OSError as err:
+            _log.warning(f"Could not write geometry raster to {store_dir}: {err}")
+    _geometry_rasters[key] = raster
+    return raster
+
+
+def raster_lookup(lon, lat, raster=None, store=None):
+    """
+    Basin and Swedish territorial seas state of each position, by indexing the raster. Positions in cells on a
+    boundary or outside the raster are resolved exactly against the polygons
+    :return: basin index into the helcom_wgs84 layer of the store (no_polygon if none) and a boolean array, True
+     within the buffered Swedish territorial seas
+    """
+    raster = raster or load_geometry_raster()
+    store = store or load_geometry_store()
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    lon_min, lat_min = raster.bounds[:2]
+    rows = np.floor((lat - lat_min) / raster.resolution)
+    cols = np.floor((lon - lon_min) / raster.resolution)
+    in_raster = (rows >= 0) & (rows < raster.basin.shape[0]) & (cols >= 0) & (cols < raster.basin.shape[1])
+    rows, cols = rows[in_raster].astype(int), cols[in_raster].astype(int)
+    basin = np.full(lon.shape, straddles_boundary, dtype=np.int16)
+    basin[in_raster] = raster.basin[rows, cols]
+    territorial = np.full(lon.shape, straddles_boundary, dtype=np.int8)
+    territorial[in_raster] = raster.territorial[rows, cols]
+    positioned = np.isfinite(lon) & np.isfinite(lat)
+    basin[~positioned] = no_polygon
+    territorial[~positioned] = 0
+    exact = basin == straddles_boundary
+    if exact.any():
+        basin[exact] = first_polygon(store["helcom_wgs84"], lon[exact], lat[exact])
+    exact = territorial == straddles_boundary
+    if exact.any():
+        territorial_seas = store["eez_12nm_buffered"]
+        polygon_index, point_index = contains_pairs(territorial_seas, lon[exact], lat[exact])
+        inside = np.zeros(exact.sum(), dtype=np.int8)
+        inside[point_index[np.isin(polygon_index, swedish_polygons(territorial_seas))]] = 1
+        territorial[exact] = inside
+    return basin, territorial.astype(bool)
@@ -0,0 +1,115 @@
+import logging
+import os
+import pathlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import netCDF4
+import numpy as np
+import xarray as xr
+
+_log = logging.getLogger(__name__)
+
+
+def attr_equal(old, new):
+    if isinstance(old, str) or isinstance(new, str):
+        return isinstance(old, str) and isinstance(new, str) and old == new
+    return np.array_equal(np.asarray(old), np.asarray(new))
+
+
+def attribute_changes(current, new):
+    """Attributes of new that are missing from current or differ from it"""
+    changes = {}
+    for key, value in new.items():
+        if key not in current:
+            _log.info(f"added {key}: {value}")
+        elif attr_equal(current[key], value):
+            continue
+        else:
+            _log.info(f"updated {key}. old: {current[key]}, new: {value}")
+        changes[key] = value
+    return changes
+
+
+def set_nc_attribute(obj, key, value):
+    # as the netCDF4 backend of xarray, so patched attributes are stored as a rewrite would store them
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, str) for item in value):
+        obj.setncattr_string(key, value)
+    else:
+        obj.setncattr(key, value)
+
+
+def patch_in_place(nc_path, global_attrs, variable_attrs):
+    """
+    Set changed attributes in the existing file, opened in append mode. For netCDF4/HDF5 files only the attribute
+    messages are written. netCDF3 files grow their header in place if it has room
+    :return: number of attributes changed
+    """
+    changed = 0
+    with netCDF4.Dataset(nc_path, "a") as nc:
+        changes = attribute_changes({key: nc.getncattr(key) for key in nc.ncattrs()}, global_attrs)
+        for key, value in changes.items():
+            set_nc_attribute(nc, key, value)
+        changed += len(changes)
+        for var_name, attrs in variable_attrs.items():
+            if var_name not in nc.variables:
+                _log.warning(f"{var_name} not found in {nc_path}. Attributes not set")
+                continue
+            variable = nc.variables[var_name]
+            changes = attribute_changes({key: variable.getncattr(key) for key in variable.ncattrs()}, attrs)
+            for key, value in changes.items():
+                set_nc_attribute(variable, key, value)
+            changed += len(changes)
+    return changed
+
+
+def rewrite(nc_path, global_attrs, variable_attrs, tempfile=None):
+    """Set attributes by rewriting the whole file through a temporary file"""
+    tempfile = tempfile or pathlib.Path(nc_path).with_suffix(".nc.tmp")
+    with xr.open_dataset(nc_path) as ds:
+        ds.load()
+    ds.attrs.update(attribute_changes(ds.attrs, global_attrs))
+    for var_name, attrs in variable_attrs.items():
+        if var_name in ds.variables:
+            ds[var_name].attrs.update(attribute_changes(ds[var_name].attrs, attrs))
+    ds.to_netcdf(tempfile)
+    shutil.move(tempfile, nc_path)
+
+
+def patch_nc_attrs(nc_path, global_attrs=None, variable_attrs=None, tempfile=None):
+    """
+    Add or update global and variable attributes of a netCDF file. Attributes are changed in place in the existing
+    file, falling back to a full rewrite only if the file cannot be updated in place
+    :param global_attrs: dict of global attributes
+    :param variable_attrs: dict of variable name to dict of attributes
+    :param tempfile: optional path for the rewrite fallback. Defaults to next to nc_path
+    :return: "in place" or "rewritten"
+    """
+    _log.info(f"working on {nc_path}")
+    global_attrs = global_attrs or {}
+    variable_attrs = variable_attrs or {}
+    try:
+        changed = patch_in_place(nc_path, global_attrs, variable_attrs)
+        _log.info(f"Patched {changed} attributes in place")
+        return "in place"
+    except (OSError, RuntimeError, TypeError, ValueError) as err:
+        _log.warning(f"Could not patch {nc_path} in place: {err}. Rewriting file")
+    rewrite(nc_path, global_attrs, variable_attrs, tempfile=tempfile)
+    _log.info("Successfully saved nc")
+    return "rewritten"
+
+
+def patch_ncs(nc_paths, global_attrs=None, variable_attrs=None, workers=None):
+    """
+    patch_nc_attrs on many files, e.g. all the profiles of a mission, concurrently on a process pool. HDF5 is not
+    thread safe, so files are patched in separate processes
+    :param workers: number of processes. Defaults to the number of CPUs
+    :return: list of the result of patch_nc_attrs for each file
+    """
+    nc_paths = list(nc_paths)
+    workers = min(workers or os.cpu_count(), len(nc_paths))
+    patch = partial(patch_nc_attrs, global_attrs=global_attrs, variable_attrs=variable_attrs)
+    if workers < 2:
+        return [patch(nc_path) for nc_path in nc_paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(patch, nc_paths, chunksize=max(1, len(nc_paths) // (4 * workers))))
@@ -1,4 +1,5 @@
 import re
+from collections import namedtuple
 import numpy as np
 import pandas as pd
 import logging
@@ -79,7 +80,10 @@ def encode_times_og1(ds):
     return ds
 
 
-def find_best_dtype(var_name, da):
+def find_best_dtype(var_name, da, maximum=None):
+    """
+    :param maximum: optional maximum of the non-NaN values of da, if already known
+    """
     input_dtype = da.dtype.type
     if "latitude" in var_name.lower() or "longitude" in var_name.lower():
         return np.double
@@ -88,9 +92,11 @@ def find_best_dtype(var_name, da):
     if "time" in var_name.lower():
         return input_dtype
     if var_name[-3:] == "raw" or "int" in str(input_dtype):
-        if np.nanmax(da.values) < 2 ** 16 / 2:
+        if maximum is None:
+            maximum = np.nanmax(da.values)
+        if maximum < 2 ** 16 / 2:
             return np.int16
-        elif np.nanmax(da.values) < 2 ** 32 / 2:
+        elif maximum < 2 ** 32 / 2:
             return np.int32
     if input_dtype == np.float64:
         return np.float32
@@ -102,26 +108,104 @@ def set_fill_value(new_dtype):
     return fill_val
 
 
-def set_best_dtype(ds):
-    bytes_in = ds.nbytes
+# Samples per chunk when scanning a variable, so all reductions of a chunk run while it is in the CPU cache
+range_chunk_samples = 2 ** 16
+# Storage of a variable in the netCDF file. fill_value, scale_factor and add_offset are None where not used
+StoragePlan = namedtuple("StoragePlan", "dtype fill_value scale_factor add_offset")
+
+
+def value_range(values, chunk_size=range_chunk_samples):
+    """
+    Minimum and maximum of the non-NaN values of an array, in one pass over it
+    :return: min, max. Both NaN if the array has no non-NaN values
+    """
+    flat = np.ravel(values)
+    minimum, maximum = np.nan, np.nan
+    for start in range(0, flat.size, chunk_size):
+        chunk = flat[start:start + chunk_size]
+        minimum = np.fmin(minimum, np.fmin.reduce(chunk))
+        maximum = np.fmax(maximum, np.fmax.reduce(chunk))
+    return minimum, maximum
+
+
+def packing(minimum, maximum, dtype=np.float32):
+    """
+    scale_factor and add_offset to pack values from minimum to maximum into int16, keeping the largest int16 as the
+    fill value. The resolution of the packed values is (maximum - minimum) / 65533
+    """
+    scale_factor = (maximum - minimum) / (2 ** 16 - 3) or 1.0
+    add_offset = minimum + (2 ** 15 - 1) * scale_factor
+    return dtype(scale_factor), dtype(add_offset)
+
+
+def plan_dtypes(ds, pack=False):
+    """
+    Decide the storage dtype of every variable of ds. Each numeric variable that needs its range is scanned once
+    :param pack: True to pack every float variable with valid_min and valid_max attributes into int16 with
+     scale_factor and add_offset, or a list of float variables to pack. Listed variables without valid_min and
+     valid_max are packed over their data range. Variables with data outside their valid range are not packed
+    :return: dict of variable name to StoragePlan
+    """
+    plans = {}
     for var_name in list(ds):
         da = ds[var_name]
         input_dtype = da.dtype.type
-        new_dtype = find_best_dtype(var_name, da)
+        attrs = da.attrs
+        bounded = "valid_min" in attrs and "valid_max" in attrs
+        if isinstance(pack, bool):
+            to_pack = pack and bounded
+        else:
+            to_pack = var_name in pack
+        to_pack = to_pack and da.dtype.kind == "f"
+        needs_range = var_name[-3:] == "raw" or "int" in str(input_dtype)
+        minimum, maximum = np.nan, np.nan
+        if (needs_range or to_pack) and da.dtype.kind in "fiu":
+            minimum, maximum = value_range(da.values)
+        new_dtype = find_best_dtype(var_name, da, maximum=maximum)
+        if to_pack and new_dtype in (np.float32, np.float64):
+            low, high = (float(attrs["valid_min"]), float(attrs["valid_max"])) if bounded else (minimum, maximum)
+            if minimum < low or maximum > high or not np.isfinite(low) or not np.isfinite(high):
+                _log.warning(f"{var_name} has values outside {low} to {high}. Not packed")
+            else:
+                scale_factor, add_offset = packing(low, high, np.dtype(new_dtype).type)
+                _log.debug(f"{var_name} packed to int16 with resolution {scale_factor:.3g}")
+                plans[var_name] = StoragePlan(np.int16, set_fill_value(np.int16), scale_factor, add_offset)
+                continue
+        fill_value = set_fill_value(new_dtype) if "int" in str(new_dtype) else None
+        plans[var_name] = StoragePlan(new_dtype, fill_value, None, None)
+    return plans
+
+
+def set_best_dtype(ds, pack=False):
+    """
+    Set the smallest adequate dtype of each variable as its netCDF encoding, applied when the dataset is written.
+    The values in memory are unchanged
+    :param pack: optionally pack bounded float variables into int16, see plan_dtypes
+    """
+    bytes_in = ds.nbytes
+    bytes_out = bytes_in
+    plans = plan_dtypes(ds, pack=pack)
+    for var_name, plan in plans.items():
+        da = ds[var_name]
+        input_dtype = da.dtype.type
         for att in ['valid_min', 'valid_max']:
             if att in da.attrs.keys():
-                da.attrs[att] = np.array(da.attrs[att]).astype(new_dtype)
-        if new_dtype == input_dtype:
+                if plan.scale_factor is None:
+                    da.attrs[att] = np.array(da.attrs[att]).astype(plan.dtype)
+                else:
+                    da.attrs[att] = np.array(np.around((float(da.attrs[att]) - plan.add_offset) / plan.scale_factor)
+                                             ).astype(plan.dtype)
+        if plan.dtype == input_dtype:
             continue
-        _log.debug(f"{var_name} input dtype {input_dtype} change to {new_dtype}")
-        da_new = da.astype(new_dtype)
-        ds = ds.drop_vars(var_name)
-        if "int" in str(new_dtype):
-            fill_val = set_fill_value(new_dtype)
-            da_new[np.isnan(da)] = fill_val
-            da_new.encoding["_FillValue"] = fill_val
-        ds[var_name] = da_new
-    bytes_out = ds.nbytes
+        _log.debug(f"{var_name} input dtype {input_dtype} change to {plan.dtype}")
+        encoding = {"dtype": np.dtype(plan.dtype)}
+        if plan.fill_value is not None:
+            encoding["_FillValue"] = plan.fill_value
+        if plan.scale_factor is not None:
+            encoding["scale_factor"] = plan.scale_factor
+            encoding["add_offset"] = plan.add_offset
+        da.encoding = encoding
+        bytes_out -= da.nbytes - da.size * np.dtype(plan.dtype).itemsize
     _log.info(f"Space saved by dtype downgrade: {int(100 * (bytes_in - bytes_out) / bytes_in)} %")
     return ds
 